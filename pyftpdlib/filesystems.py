@@ -2,6 +2,8 @@
 # Use of this source code is governed by MIT license that can be
 # found in the LICENSE file.
 
+import collections
+import functools
 import os
 import stat
 import tempfile
@@ -35,6 +37,38 @@ _months_map = {
     12: "Dec",
 }
 
+# max number of entries held by AbstractedFS path conversion caches
+_PATH_CACHE_SIZE = 256
+# max number of entries held by AbstractedFS validpath() cache
+_VALIDPATH_CACHE_SIZE = 64
+
+
+def _path_cache(fun):
+    """A decorator for AbstractedFS methods which are pure functions of
+    (root, cwd, path). Results are cached per-instance in a LRU cache
+    holding up to _PATH_CACHE_SIZE entries. Subclasses overriding
+    __init__ without calling AbstractedFS.__init__ get no caching.
+    """
+    name = fun.__name__
+
+    @functools.wraps(fun)
+    def wrapper(self, path):
+        cache = getattr(self, "_path_cache", None)
+        if cache is None:
+            return fun(self, path)
+        key = (name, self.root, self.cwd, path)
+        try:
+            ret = cache[key]
+        except KeyError:
+            ret = cache[key] = fun(self, path)
+            if len(cache) > _PATH_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return ret
+
+    return wrapper
+
 
 # ===================================================================
 # --- base class
@@ -72,6 +106,17 @@ class AbstractedFS:
         # are responsible to set _cwd attribute as necessary.
         self._cwd = "/"
         self._root = root
+        self._root_cache = None
+        self._path_cache = collections.OrderedDict()
+        # validpath() results depend on the filesystem state, so they
+        # are cached only for the duration of a single FTP command
+        # (the FTPHandler clears this on every new command). If
+        # there's no FTPHandler (or a subclass doesn't call this
+        # method) the cache is disabled.
+        if cmd_channel is not None:
+            self._validpath_cache = collections.OrderedDict()
+        else:
+            self._validpath_cache = None
         self.cmd_channel = cmd_channel
 
     @property
@@ -104,81 +149,180 @@ class AbstractedFS:
             return True
         return os.path.isabs(path)
 
-    def ftpnorm(self, ftppath):
-        """Normalize a "virtual" ftp pathname (typically the raw string
-        coming from client) depending on the current working directory.
+    if os.sep == "/":
 
-        Example (having "/foo" as current working directory):
-        >>> ftpnorm('bar')
-        '/foo/bar'
+        @_path_cache
+        def ftpnorm(self, ftppath):
+            """Normalize a "virtual" ftp pathname (typically the raw
+            string coming from client) depending on the current working
+            directory.
 
-        Note: directory separators are system independent ("/").
-        Pathname returned is always absolutized.
-        """
-        if self._isabs(ftppath):
-            p = os.path.normpath(ftppath)
-        else:
-            p = os.path.normpath(os.path.join(self.cwd, ftppath))
-        # normalize string in a standard web-path notation having '/'
-        # as separator.
-        if os.sep == "\\":
+            Example (having "/foo" as current working directory):
+            >>> ftpnorm('bar')
+            '/foo/bar'
+
+            Note: directory separators are system independent ("/").
+            Pathname returned is always absolutized.
+            """
+            ftppath = os.fspath(ftppath)
+            if ftppath.startswith("/"):
+                p = ftppath
+            else:
+                cwd = self.cwd
+                if cwd and not cwd.endswith("/"):
+                    cwd += "/"
+                p = cwd + ftppath
+            # Anti path traversal: don't trust user input, in the event
+            # that self.cwd is not absolute, return "/" as a safety
+            # measure. This is for extra protection, maybe not really
+            # necessary.
+            if not p.startswith("/"):
+                return "/"
+            # Fast path: most clients send paths which are already
+            # normalized (no "." / ".." / empty segments), in which
+            # case there's nothing to do.
+            if "//" not in p and "/." not in p:
+                if p == "/" or not p.endswith("/"):
+                    return p
+            # Slow path: resolve "." and ".." segments and collapse
+            # redundant separators in a single pass, keeping track of
+            # the (start, end) offsets of the surviving segments.
+            segments = []
+            append = segments.append
+            find = p.find
+            i = 0
+            size = len(p)
+            while i < size:
+                if p[i] == "/":
+                    i += 1
+                    continue
+                j = find("/", i)
+                if j == -1:
+                    j = size
+                seglen = j - i
+                if seglen == 1 and p[i] == ".":
+                    pass
+                elif seglen == 2 and p[i] == "." and p[i + 1] == ".":
+                    if segments:
+                        segments.pop()
+                else:
+                    append((i, j))
+                i = j
+            return "/" + "/".join([p[x:y] for x, y in segments])
+
+    else:
+
+        @_path_cache
+        def ftpnorm(self, ftppath):
+            ftppath = os.fspath(ftppath)
+            if self._isabs(ftppath):
+                p = os.path.normpath(ftppath)
+            else:
+                p = os.path.normpath(os.path.join(self.cwd, ftppath))
+            # normalize string in a standard web-path notation having
+            # '/' as separator.
             p = p.replace("\\", "/")
-        # os.path.normpath supports UNC paths (e.g. "//a/b/c") but we
-        # don't need them.  In case we get an UNC path we collapse
-        # redundant separators appearing at the beginning of the string
-        while p[:2] == "//":
-            p = p[1:]
-        # Anti path traversal: don't trust user input, in the event
-        # that self.cwd is not absolute, return "/" as a safety measure.
-        # This is for extra protection, maybe not really necessary.
-        if not self._isabs(p):
-            p = "/"
-        return p
-
-    def ftp2fs(self, ftppath):
-        """Translate a "virtual" ftp pathname (typically the raw string
-        coming from client) into equivalent absolute "real" filesystem
-        pathname.
-
-        Example (having "/home/user" as root directory):
-        >>> ftp2fs("foo")
-        '/home/user/foo'
-
-        Note: directory separators are system dependent.
-        """
-        # as far as I know, it should always be path traversal safe...
-        if os.path.normpath(self.root) == os.sep:
-            return os.path.normpath(self.ftpnorm(ftppath))
-        else:
-            p = self.ftpnorm(ftppath)[1:]
-            return os.path.normpath(os.path.join(self.root, p))
+            # os.path.normpath supports UNC paths (e.g. "//a/b/c") but
+            # we don't need them.  In case we get an UNC path we
+            # collapse redundant separators appearing at the beginning
+            # of the string.
+            while p[:2] == "//":
+                p = p[1:]
+            # Anti path traversal: don't trust user input, in the event
+            # that self.cwd is not absolute, return "/" as a safety
+            # measure.
+            if not self._isabs(p):
+                p = "/"
+            return p
+
+    if os.sep == "/":
+
+        @_path_cache
+        def ftp2fs(self, ftppath):
+            """Translate a "virtual" ftp pathname (typically the raw
+            string coming from client) into equivalent absolute "real"
+            filesystem pathname.
 
-    def fs2ftp(self, fspath):
-        """Translate a "real" filesystem pathname into equivalent
-        absolute "virtual" ftp pathname depending on the user's
-        root directory.
+            Example (having "/home/user" as root directory):
+            >>> ftp2fs("foo")
+            '/home/user/foo'
 
-        Example (having "/home/user" as root directory):
-        >>> fs2ftp("/home/user/foo")
-        '/foo'
+            Note: directory separators are system dependent.
+            """
+            # ftpnorm() returns an already normalized absolute path, so
+            # a plain concatenation is enough.
+            root, _, bareroot = self._root_prefixes()
+            p = self.ftpnorm(ftppath)
+            if root == "/":
+                return p
+            if p == "/":
+                return bareroot
+            return root + p[1:]
 
-        As for ftpnorm, directory separators are system independent
-        ("/") and pathname returned is always absolutized.
+        def fs2ftp(self, fspath):
+            """Translate a "real" filesystem pathname into equivalent
+            absolute "virtual" ftp pathname depending on the user's
+            root directory.
 
-        On invalid pathnames escaping from user's root directory
-        (e.g. "/home" when root is "/home/user") always return "/".
-        """
-        if self._isabs(fspath):
-            p = os.path.normpath(fspath)
-        else:
-            p = os.path.normpath(os.path.join(self.root, fspath))
-        if not self.validpath(p):
-            return "/"
-        p = p.replace(os.sep, "/")
-        p = p[len(self.root) :]
-        if not p.startswith("/"):
-            p = "/" + p
-        return p
+            Example (having "/home/user" as root directory):
+            >>> fs2ftp("/home/user/foo")
+            '/foo'
+
+            As for ftpnorm, directory separators are system independent
+            ("/") and pathname returned is always absolutized.
+
+            On invalid pathnames escaping from user's root directory
+            (e.g. "/home" when root is "/home/user") always return "/".
+            """
+            fspath = os.fspath(fspath)
+            if fspath.startswith("/"):
+                p = os.path.normpath(fspath)
+            else:
+                p = os.path.normpath(os.path.join(self.root, fspath))
+            if not self.validpath(p):
+                return "/"
+            root = self._root_prefixes()[0]
+            if p.startswith(root):
+                p = p[len(root) :]
+            elif p + "/" == root:
+                return "/"
+            else:
+                p = p[len(self.root) :]
+            if not p.startswith("/"):
+                p = "/" + p
+            return p
+
+    else:
+
+        @_path_cache
+        def ftp2fs(self, ftppath):
+            # as far as I know, it should always be path traversal
+            # safe...
+            if self._root_prefixes()[0] == os.sep:
+                return os.path.normpath(self.ftpnorm(ftppath))
+            else:
+                p = self.ftpnorm(ftppath)[1:]
+                return os.path.normpath(os.path.join(self.root, p))
+
+        def fs2ftp(self, fspath):
+            fspath = os.fspath(fspath)
+            if self._isabs(fspath):
+                p = os.path.normpath(fspath)
+            else:
+                p = os.path.normpath(os.path.join(self.root, fspath))
+            if not self.validpath(p):
+                return "/"
+            root = self._root_prefixes()[0]
+            if p.startswith(root):
+                p = p[len(root) :]
+            elif p + os.sep == root:
+                return "/"
+            else:
+                p = p[len(self.root) :]
+            p = p.replace(os.sep, "/")
+            if not p.startswith("/"):
+                p = "/" + p
+            return p
 
     def validpath(self, path):
         """Check whether the path belongs to user's home directory.
@@ -190,13 +334,95 @@ class AbstractedFS:
         Pathnames escaping from user's root directory are considered
         not valid.
         """
-        root = self.realpath(self.root)
+        path = os.fspath(path)
+        cache = getattr(self, "_validpath_cache", None)
+        if cache is None:
+            return self._validpath(path)
+        key = (self.root, path)
+        try:
+            ret = cache[key]
+        except KeyError:
+            ret = cache[key] = self._validpath(path)
+            if len(cache) > _VALIDPATH_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return ret
+
+    def _validpath(self, path):
+        if self._validpath_lexical(path):
+            return True
+        realroot = self._root_prefixes()[1]
         path = self.realpath(path)
-        if not root.endswith(os.sep):
-            root += os.sep
         if not path.endswith(os.sep):
             path += os.sep
-        return path[0 : len(root)] == root
+        return path.startswith(realroot)
+
+    def _clear_validpath_cache(self):
+        cache = getattr(self, "_validpath_cache", None)
+        if cache:
+            cache.clear()
+
+    def _root_prefixes(self):
+        # Return a (normroot, realroot, bareroot) tuple where normroot
+        # is the normalized root directory and realroot its canonical
+        # version, both ending with a separator, so that they can be
+        # used for prefix matching. bareroot is normroot without the
+        # trailing separator (unless root is "/"). They are cached
+        # and recalculated only if root changes, so that the same
+        # string objects are returned on every call.
+        root = self.root
+        cached = getattr(self, "_root_cache", None)
+        if cached is None or cached[0] is not root:
+            bareroot = os.path.normpath(root)
+            realroot = self.realpath(root)
+            normroot = bareroot
+            if not normroot.endswith(os.sep):
+                normroot += os.sep
+            if not realroot.endswith(os.sep):
+                realroot += os.sep
+            cached = (root, (normroot, realroot, bareroot))
+            self._root_cache = cached
+        return cached[1]
+
+    if os.sep == "/":
+
+        def _validpath_lexical(self, path):
+            # Fast path for validpath(). If the (absolute, POSIX) path
+            # lexically lives under root and none of its components below
+            # root is a symlink, its canonical version necessarily lives
+            # under the canonical root as well, meaning we can avoid
+            # resolving the whole path via realpath(), which lstat()s every
+            # single component starting from "/". Return False if that
+            # can't be determined, in which case the caller is supposed to
+            # fall back on realpath().
+            if not path.startswith("/") or ".." in path:
+                return False
+            prefix = self._root_prefixes()[0]
+            path = os.path.normpath(path)
+            if path == prefix[:-1] or path == prefix:
+                return True
+            if not path.startswith(prefix):
+                return False
+            p = prefix
+            for name in path[len(prefix) :].split("/"):
+                p += name
+                try:
+                    st = self.lstat(p)
+                except FileNotFoundError:
+                    # Nothing exists from here on, hence no symlinks.
+                    return True
+                except (OSError, FilesystemError):
+                    return False
+                if stat.S_ISLNK(st.st_mode):
+                    return False
+                p += "/"
+            return True
+
+    else:
+
+        def _validpath_lexical(self, path):
+            return False
 
     # --- Wrapper methods around open() and tempfile.mkstemp
 
@@ -239,6 +465,7 @@ class AbstractedFS:
     def mkdir(self, path):
         """Create the specified directory."""
         os.mkdir(path)
+        self._clear_validpath_cache()
 
     def listdir(self, path):
         """List the content of a directory."""
@@ -251,14 +478,17 @@ class AbstractedFS:
     def rmdir(self, path):
         """Remove the specified directory."""
         os.rmdir(path)
+        self._clear_validpath_cache()
 
     def remove(self, path):
         """Remove the specified file."""
         os.remove(path)
+        self._clear_validpath_cache()
 
     def rename(self, src, dst):
         """Rename the specified src file to the dst filename."""
         os.rename(src, dst)
+        self._clear_validpath_cache()
 
     def chmod(self, path, mode):
         """Change file/directory mode."""
@@ -611,7 +841,7 @@ if os.name == "posix":
             return self.ftpnorm(ftppath)
 
         def fs2ftp(self, fspath):
-            return fspath
+            return os.fspath(fspath)
 
         def validpath(self, path):
             # validpath was used to check symlinks escaping user home
@@ -686,6 +686,10 @@ class FTPHandler(AsyncChat):
 
     def pre_process_command(self, line, cmd, arg):
         kwargs = {}
+        # AbstractedFS caches validpath() results for the duration of
+        # a single command only.
+        if isinstance(self.fs, AbstractedFS):
+            self.fs._clear_validpath_cache()
         if cmd == "SITE" and arg:
             cmd = f"SITE {arg.split(' ')[0].upper()}"
             arg = line[len(cmd) + 1 :]
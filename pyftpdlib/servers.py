@@ -250,8 +250,9 @@ class FTPServer(Acceptor):
         )
 
         if handle_exit:
+            soonest = None
             try:
-                self.ioloop.loop(timeout, blocking)
+                soonest = self.ioloop.loop(timeout, blocking)
             except (KeyboardInterrupt, SystemExit):
                 logger.info("received interrupt signal")
             if blocking:
@@ -263,8 +264,9 @@ class FTPServer(Acceptor):
                         self._map_len(),
                     )
                 self.close_all()
+            return soonest
         else:
-            self.ioloop.loop(timeout, blocking)
+            return self.ioloop.loop(timeout, blocking)
 
     def handle_accepted(self, sock, addr):
         """Called when remote client initiates a connection."""
@@ -497,8 +499,9 @@ class _SpawnerBase(FTPServer):
             log = handle_exit and blocking
             if log:
                 self._log_start()
+            soonest = None
             try:
-                self.ioloop.loop(timeout, blocking)
+                soonest = self.ioloop.loop(timeout, blocking)
             except (KeyboardInterrupt, SystemExit):
                 pass
             if blocking:
@@ -508,8 +511,9 @@ class _SpawnerBase(FTPServer):
                         self._map_len(),
                     )
                 self.close_all()
+            return soonest
         else:
-            self.ioloop.loop(timeout, blocking)
+            return self.ioloop.loop(timeout, blocking)
 
     def _terminate_task(self, t):
         if hasattr(t, "terminate"):
@@ -41,6 +41,7 @@ GITHUB_ACTIONS = "GITHUB_ACTIONS" in os.environ or "CIBUILDWHEEL" in os.environ
 CI_TESTING = GITHUB_ACTIONS
 COVERAGE = "COVERAGE_RUN" in os.environ
 PYTEST_PARALLEL = "PYTEST_XDIST_WORKER" in os.environ  # `make test-parallel`
+STRESS_TESTING = "PYFTPDLIB_STRESS" in os.environ
 
 # Attempt to use IP rather than hostname (test suite will run a lot faster)
 try:
@@ -52,10 +53,15 @@ USER = "user"
 PASSWD = "12345"
 HOME = os.getcwd()
 # Use PID to disambiguate file name for parallel testing.
-TESTFN_PREFIX = f"pyftpd-tmp-{os.getpid()}-"
+TESTFN_BASE_PREFIX = "pyftpd-tmp-"
+TESTFN_PREFIX = f"{TESTFN_BASE_PREFIX}{os.getpid()}-"
 GLOBAL_TIMEOUT = 2
 BUFSIZE = 1024
 INTERRUPTED_TRANSF_SIZE = 32768
+# How many times b"abcde12345" is repeated in the data moved by STOR
+# and RETR tests: enough to span multiple reads / writes of the data
+# channel buffers, small enough to keep the test suite fast.
+PAYLOAD_TIMES = 100000 if STRESS_TESTING else 10000
 NO_RETRIES = 5
 VERBOSITY = 1 if os.getenv("SILENT") else 2
 
@@ -91,10 +97,52 @@ class PyftpdlibTestCase(unittest.TestCase):
         return fname
 
 
-def close_client(session):
-    """Closes a ftplib.FTP client session."""
+class SharedServerTestCase(PyftpdlibTestCase):
+    """A test class which starts a single FTP server (self.server) in
+    setUpClass() and shares it across all of its unit-tests, instead
+    of starting and stopping one per test. Subclasses are expected to
+    connect a client in setUp() and close it in tearDown().
+    """
+
+    server_class = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = cls.server_class()
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        # reset_server_opts() also wiped the authorizer we set on
+        # server creation
+        self.server.handler.authorizer = self.server.authorizer
+
+    def tearDown(self):
+        # Wait for the server to dispose the client connection(s) so
+        # that they don't outlive the test.
+        server = self.server.server
+        if hasattr(server, "_active_tasks"):
+            call_until(server._map_len, "ret == 0")
+        else:
+            call_until(server._map_len, "ret == 1")  # the acceptor
+        super().tearDown()
+
+
+def close_client(session, quit=True):
+    """Closes a ftplib.FTP client session. If quit is False the
+    connection is just dropped, without sending QUIT first (and
+    waiting for its response).
+    """
     try:
-        if session.sock is not None:
+        if session.sock is None:
+            pass
+        elif quit:
             try:
                 resp = session.quit()
             except Exception:
@@ -103,6 +151,11 @@ def close_client(session):
                 # ...just to make sure the server isn't replying to some
                 # pending command.
                 assert resp.startswith("221"), resp
+        else:
+            # shutdown() disconnects also in case the socket fd was
+            # inherited by a (forked) server process
+            with contextlib.suppress(OSError):
+                session.sock.shutdown(socket.SHUT_RDWR)
     finally:
         session.close()
 
@@ -257,7 +310,9 @@ class retry:
 
 def retry_on_failure(fun):
     """Decorator which runs a test function and retries N times before
-    actually failing.
+    actually failing. Retries are spaced by an exponential backoff
+    (5ms, 10ms, 20ms, ... up to 100ms) giving transient conditions
+    (e.g. a loaded CI machine) a chance to settle.
     """
 
     @functools.wraps(fun)
@@ -268,11 +323,12 @@ def retry_on_failure(fun):
             except AssertionError as exc:
                 if x + 1 >= NO_RETRIES:
                     raise
-                msg = f"{exc!r}, retrying"
+                msg = f"{exc!r}, retrying ({x + 1}/{NO_RETRIES - 1})"
                 print(msg, file=sys.stderr)  # noqa: T201
                 if PYTEST_PARALLEL:
                     warnings.warn(msg, ResourceWarning, stacklevel=2)
                 self.tearDown()
+                time.sleep(min(0.1, 0.005 * 2**x))
                 self.setUp()
 
     return wrapper
@@ -419,7 +475,7 @@ class FtpdThreadWrapper(threading.Thread):
 
     handler = FTPHandler
     server_class = FTPServer
-    poll_interval = 0.001 if CI_TESTING else 0.000001
+    poll_interval = 0.001
     # Makes the thread stop on interpreter exit.
     daemon = True
 
@@ -428,18 +484,25 @@ class FtpdThreadWrapper(threading.Thread):
         super().__init__(name="test-ftpd")
         self.server = setup_server(self.handler, self.server_class, addr=addr)
         self.host, self.port = self.server.socket.getsockname()[:2]
+        self.authorizer = self.handler.authorizer
 
         self.lock = threading.Lock()
         self._stop_flag = False
         self._event_stop = threading.Event()
 
     def run(self):
+        timeout = self.poll_interval
         try:
             while not self._stop_flag:
                 with self.lock:
-                    self.server.serve_forever(
-                        timeout=self.poll_interval, blocking=False
+                    soonest = self.server.serve_forever(
+                        timeout=timeout, blocking=False
                     )
+                # Sleep in the poller until an IO event occurs, waking
+                # up in time for the next scheduled call (if any).
+                timeout = self.poll_interval
+                if soonest is not None:
+                    timeout = min(soonest, timeout)
         finally:
             self._event_stop.set()
 
@@ -466,6 +529,7 @@ if POSIX:
                 self.handler, self.server_class, addr=addr
             )
             self.host, self.port = self.server.socket.getsockname()[:2]
+            self.authorizer = self.handler.authorizer
             self._started = False
 
         def run(self):
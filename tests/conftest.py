@@ -25,8 +25,9 @@ import pytest
 from pyftpdlib.ioloop import IOLoop
 
 from . import POSIX
-from . import ROOT_DIR
+from . import TESTFN_BASE_PREFIX
 from . import TESTFN_PREFIX
+from . import SharedServerTestCase
 from . import safe_rmpath
 
 # set it to True to raise an exception instead of warning
@@ -92,7 +93,10 @@ def setup_method(origin):
 
 def teardown_method(setup_ctx, request):
     assert_closed_resources(setup_ctx, request)
-    assert_closed_ioloop()
+    # the server shared by these tests is still listening (and it's
+    # stopped on class teardown)
+    if not isinstance(request.instance, SharedServerTestCase):
+        assert_closed_ioloop()
 
 
 @pytest.fixture(autouse=True, scope="function")
@@ -101,8 +105,23 @@ def for_each_test_method(request):
     request.addfinalizer(lambda: teardown_method(ctx, request))
 
 
+def is_stale_testfn(name):
+    """Return True if name is a test file created by this process, or
+    by a test run which is no longer running (e.g. it got killed
+    before it could clean up after itself).
+    """
+    if name.startswith(TESTFN_PREFIX):
+        return True
+    if not name.startswith(TESTFN_BASE_PREFIX):
+        return False
+    pid = name[len(TESTFN_BASE_PREFIX) :].split("-", 1)[0]
+    return pid.isdigit() and not psutil.pid_exists(int(pid))
+
+
 @atexit.register
 def on_exit():
-    for name in os.listdir(ROOT_DIR):
-        if name.startswith(TESTFN_PREFIX):
-            safe_rmpath(os.path.join(ROOT_DIR, name))
+    # get_testfn() creates test files in the cwd by default
+    cwd = os.getcwd()
+    for name in os.listdir(cwd):
+        if is_stale_testfn(name):
+            safe_rmpath(os.path.join(cwd, name))
@@ -3,6 +3,7 @@
 # found in the LICENSE file.
 
 import os
+import pathlib
 import tempfile
 
 import pytest
@@ -12,19 +13,81 @@ from pyftpdlib.filesystems import AbstractedFS
 from . import HOME
 from . import POSIX
 from . import PyftpdlibTestCase
+from . import get_testfn
 from . import safe_rmpath
 from . import touch
 
 if POSIX:
     from pyftpdlib.filesystems import UnixFilesystem
 
+# (cwd, ftp path, expected fs path relative to root)
+FTP2FS_CASES = [
+    ("/", "", ""),
+    ("/", "/", ""),
+    ("/", ".", ""),
+    ("/", "..", ""),
+    ("/", "a", "a"),
+    ("/", "/a", "a"),
+    ("/", "/a/", "a"),
+    ("/", "a/..", ""),
+    ("/", "a/b", "a/b"),
+    ("/", "/a/b", "a/b"),
+    ("/", "/a/b/..", "a"),
+    ("/", "/a/b/../..", ""),
+    ("/sub", "", "sub"),
+    ("/sub", "/", ""),
+    ("/sub", ".", "sub"),
+    ("/sub", "..", ""),
+    ("/sub", "a", "sub/a"),
+    ("/sub", "a/", "sub/a"),
+    ("/sub", "a/..", "sub"),
+    ("/sub", "a/b", "sub/a/b"),
+    ("/sub", "a/b/..", "sub/a"),
+    ("/sub", "a/b/../..", "sub"),
+    ("/sub", "a/b/../../..", ""),
+    # UNC paths must be collapsed
+    ("/sub", "//a", "a"),
+]
+
+# (fs path relative to root, expected ftp path)
+FS2FTP_CASES = [
+    ("/", "/"),
+    (".", "/"),
+    # can't escape from root
+    ("..", "/"),
+    ("a", "/a"),
+    ("a/", "/a"),
+    ("a/..", "/"),
+    ("a/b", "/a/b"),
+    ("a/b/..", "/a"),
+    ("/a/b/../..", "/"),
+]
+
 
 class TestAbstractedFS(PyftpdlibTestCase):
     """Test for conversion utility methods of AbstractedFS class."""
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # A directory living under HOME shared by all tests of this
+        # class, which are expected to create their files in here.
+        # It gets removed (once) on class teardown.
+        cls.tmpdir = os.path.join(HOME, get_testfn())
+        os.mkdir(cls.tmpdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        safe_rmpath(cls.tmpdir)
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.fs = AbstractedFS("/", None)
+
     def test_ftpnorm(self):
         # Tests for ftpnorm method.
-        fs = AbstractedFS("/", None)
+        fs = self.fs
 
         fs._cwd = "/"
         assert fs.ftpnorm("") == "/"
@@ -53,44 +116,34 @@ class TestAbstractedFS(PyftpdlibTestCase):
         assert fs.ftpnorm("a/b/../..") == "/sub"
         assert fs.ftpnorm("a/b/../../..") == "/"
         assert fs.ftpnorm("//") == "/"  # UNC paths must be collapsed
+        assert fs.ftpnorm("a//b") == "/sub/a/b"
+        assert fs.ftpnorm("./a/./b/.") == "/sub/a/b"
+        assert fs.ftpnorm("/a/../../b") == "/b"
+        assert fs.ftpnorm(".a/..b") == "/sub/.a/..b"
+        # already normalized paths (returned as-is)
+        assert fs.ftpnorm("/a/b.c") == "/a/b.c"
+        assert fs.ftpnorm("a.b/c..") == "/sub/a.b/c.."
+        # paths which look like they need normalization but don't
+        assert fs.ftpnorm("/.a/b") == "/.a/b"
+        assert fs.ftpnorm("/a/...") == "/a/..."
+        # paths which need normalization
+        assert fs.ftpnorm("/a/b/") == "/a/b"
+        assert fs.ftpnorm("/a/b/.") == "/a/b"
+        assert fs.ftpnorm("/a/b/..") == "/a"
 
     def test_ftp2fs(self):
         # Tests for ftp2fs method.
         def join(x, y):
             return os.path.join(x, y.replace("/", os.sep))
 
-        fs = AbstractedFS("/", None)
+        fs = self.fs
 
         def goforit(root):
             fs._root = root
-            fs._cwd = "/"
-            assert fs.ftp2fs("") == root
-            assert fs.ftp2fs("/") == root
-            assert fs.ftp2fs(".") == root
-            assert fs.ftp2fs("..") == root
-            assert fs.ftp2fs("a") == join(root, "a")
-            assert fs.ftp2fs("/a") == join(root, "a")
-            assert fs.ftp2fs("/a/") == join(root, "a")
-            assert fs.ftp2fs("a/..") == root
-            assert fs.ftp2fs("a/b") == join(root, r"a/b")
-            assert fs.ftp2fs("/a/b") == join(root, r"a/b")
-            assert fs.ftp2fs("/a/b/..") == join(root, "a")
-            assert fs.ftp2fs("/a/b/../..") == root
-
-            fs._cwd = "/sub"
-            assert fs.ftp2fs("") == join(root, "sub")
-            assert fs.ftp2fs("/") == root
-            assert fs.ftp2fs(".") == join(root, "sub")
-            assert fs.ftp2fs("..") == root
-            assert fs.ftp2fs("a") == join(root, "sub/a")
-            assert fs.ftp2fs("a/") == join(root, "sub/a")
-            assert fs.ftp2fs("a/..") == join(root, "sub")
-            assert fs.ftp2fs("a/b") == join(root, "sub/a/b")
-            assert fs.ftp2fs("a/b/..") == join(root, "sub/a")
-            assert fs.ftp2fs("a/b/../..") == join(root, "sub")
-            assert fs.ftp2fs("a/b/../../..") == root
-            # UNC paths must be collapsed
-            assert fs.ftp2fs("//a"), join(root, "a")
+            for cwd, ftppath, expected in FTP2FS_CASES:
+                fs._cwd = cwd
+                expected = join(root, expected) if expected else root
+                assert fs.ftp2fs(ftppath) == expected, (cwd, ftppath)
 
         if os.sep == "\\":
             goforit(r"C:\dir")
@@ -110,22 +163,13 @@ class TestAbstractedFS(PyftpdlibTestCase):
         def join(x, y):
             return os.path.join(x, y.replace("/", os.sep))
 
-        fs = AbstractedFS("/", None)
+        fs = self.fs
 
         def goforit(root):
             fs._root = root
             assert fs.fs2ftp(root) == "/"
-            assert fs.fs2ftp(join(root, "/")) == "/"
-            assert fs.fs2ftp(join(root, ".")) == "/"
-            # can't escape from root
-            assert fs.fs2ftp(join(root, "..")) == "/"
-            assert fs.fs2ftp(join(root, "a")) == "/a"
-            assert fs.fs2ftp(join(root, "a/")) == "/a"
-            assert fs.fs2ftp(join(root, "a/..")) == "/"
-            assert fs.fs2ftp(join(root, "a/b")) == "/a/b"
-            assert fs.fs2ftp(join(root, "a/b")) == "/a/b"
-            assert fs.fs2ftp(join(root, "a/b/..")) == "/a"
-            assert fs.fs2ftp(join(root, "/a/b/../..")) == "/"
+            for fspath, expected in FS2FTP_CASES:
+                assert fs.fs2ftp(join(root, fspath)) == expected, fspath
             fs._cwd = "/sub"
             assert fs.fs2ftp(join(root, "a/")) == "/a"
 
@@ -148,48 +192,130 @@ class TestAbstractedFS(PyftpdlibTestCase):
             assert fs.fs2ftp("/__home") == "/"
             assert fs.fs2ftp("/") == "/"
             assert fs.fs2ftp("/__home/userx") == "/"
+            # root is not normalized
+            fs._root = "/__home/./user/"
+            assert fs.fs2ftp("/__home/user/a") == "/a"
+            assert fs.fs2ftp("/__home/user") == "/"
         else:
             # os.sep == ':'? Don't know... let's try it anyway
             goforit(os.getcwd())
 
+    @pytest.mark.skipif(not POSIX, reason="UNIX only")
+    def test_path_cache(self):
+        fs = AbstractedFS("/home/user", None)
+        assert fs.ftp2fs("a") == "/home/user/a"
+        fs.cwd = "/sub"
+        assert fs.ftp2fs("a") == "/home/user/sub/a"
+        fs.root = "/home/other"
+        assert fs.ftp2fs("a") == "/home/other/sub/a"
+        # cache is bounded
+        for x in range(1000):
+            fs.ftpnorm(str(x))
+        assert len(fs._path_cache) <= 256
+
+    @pytest.mark.skipif(not POSIX, reason="UNIX only")
+    def test_pathlike(self):
+        fs = AbstractedFS("/home/user", None)
+        assert fs.ftpnorm(pathlib.PurePath("a/b")) == "/a/b"
+        assert fs.ftp2fs(pathlib.PurePath("a/b")) == "/home/user/a/b"
+        fs._root = HOME
+        assert fs.fs2ftp(pathlib.Path(HOME, "a")) == "/a"
+        assert fs.validpath(pathlib.Path(HOME, "a"))
+
     def test_validpath(self):
         # Tests for validpath method.
-        fs = AbstractedFS("/", None)
+        fs = self.fs
         fs._root = HOME
         assert fs.validpath(HOME)
         assert fs.validpath(HOME + "/")
         assert not fs.validpath(HOME + "bar")
 
-    if hasattr(os, "symlink"):
-
-        def test_validpath_validlink(self):
-            # Test validpath by issuing a symlink pointing to a path
-            # inside the root directory.
-            testfn = self.get_testfn()
-            testfn2 = self.get_testfn()
-            fs = AbstractedFS("/", None)
-            fs._root = HOME
-            touch(testfn)
-            os.symlink(testfn, testfn2)
-            assert fs.validpath(testfn)
-
-        def test_validpath_external_symlink(self):
-            # Test validpath by issuing a symlink pointing to a path
-            # outside the root directory.
-            fs = AbstractedFS("/", None)
-            fs._root = HOME
-            # tempfile should create our file in /tmp directory
-            # which should be outside the user root.  If it is
-            # not we just skip the test.
-            testfn = self.get_testfn()
-            with tempfile.NamedTemporaryFile() as file:
-                try:
-                    if os.path.dirname(file.name) == HOME:
-                        return
-                    os.symlink(file.name, testfn)
-                    assert not fs.validpath(testfn)
-                finally:
-                    safe_rmpath(testfn)
+    def test_validpath_cache(self):
+        # No FTPHandler = no cache.
+        assert self.fs._validpath_cache is None
+        fs = AbstractedFS(HOME, object())
+        testfn = os.path.join(self.tmpdir, "validpath-cache")
+        assert fs.validpath(testfn)
+        assert (HOME, testfn) in fs._validpath_cache
+        # Operations modifying the filesystem invalidate the cache.
+        fs.mkdir(testfn)
+        assert not fs._validpath_cache
+        assert fs.validpath(testfn)
+        fs.rmdir(testfn)
+        assert not fs._validpath_cache
+        # Results are cached per root, even if it's changed directly.
+        assert fs.validpath(testfn)
+        fs._root = os.path.join(self.tmpdir, "other")
+        assert not fs.validpath(testfn)
+
+    def test_no_base_init(self):
+        # Subclasses not calling AbstractedFS.__init__ work uncached.
+        class FS(AbstractedFS):
+            def __init__(self, root, cmd_channel):
+                self._root = root
+                self._cwd = "/"
+                self.cmd_channel = cmd_channel
+
+        fs = FS(HOME, object())
+        assert fs.ftpnorm("a") == "/a"
+        assert fs.ftp2fs("a") == os.path.join(HOME, "a")
+        assert fs.fs2ftp(os.path.join(HOME, "a")) == "/a"
+        assert fs.validpath(HOME)
+        fs._clear_validpath_cache()
+
+    @pytest.mark.skipif(
+        not hasattr(os, "symlink"), reason="symlinks not supported"
+    )
+    def test_validpath_validlink(self):
+        # Test validpath by issuing a symlink pointing to a path
+        # inside the root directory.
+        testfn = os.path.join(self.tmpdir, "validlink")
+        testfn2 = os.path.join(self.tmpdir, "validlink-symlink")
+        fs = self.fs
+        fs._root = HOME
+        touch(testfn)
+        os.symlink(testfn, testfn2)
+        assert fs.validpath(testfn)
+        assert fs.validpath(testfn2)
+
+    @pytest.mark.skipif(
+        not hasattr(os, "symlink"), reason="symlinks not supported"
+    )
+    def test_validpath_external_symlink(self):
+        # Test validpath by issuing a symlink pointing to a path
+        # outside the root directory.
+        fs = self.fs
+        fs._root = HOME
+        # The symlink points to a (non existent) path in the /tmp
+        # directory, which should be outside the user root. If it
+        # is not we just skip the test. The target doesn't need to
+        # exist as realpath() resolves the symlink anyway.
+        tmpdir = tempfile.gettempdir()
+        if tmpdir == HOME:
+            return
+        testfn = os.path.join(self.tmpdir, "external-symlink")
+        os.symlink(os.path.join(tmpdir, get_testfn(dir=tmpdir)), testfn)
+        assert not fs.validpath(testfn)
+
+    @pytest.mark.skipif(
+        not hasattr(os, "symlink"), reason="symlinks not supported"
+    )
+    def test_validpath_external_symlink_dir(self):
+        # Test validpath by issuing an absolute path having a
+        # symlink to a directory outside the root directory as one
+        # of its components.
+        fs = self.fs
+        fs._root = HOME
+        testfn = os.path.join(self.tmpdir, "external-symlink-dir")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if os.path.dirname(tmpdir) == HOME:
+                return
+            os.symlink(tmpdir, testfn)
+            assert not fs.validpath(testfn)
+            assert not fs.validpath(os.path.join(testfn, "foo"))
+            touch(os.path.join(tmpdir, "foo"))
+            assert not fs.validpath(os.path.join(testfn, "foo"))
+            assert fs.validpath(os.path.join(HOME, "foo", "bar"))
 
 
 @pytest.mark.skipif(not POSIX, reason="UNIX only")
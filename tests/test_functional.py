@@ -2,19 +2,25 @@
 # Use of this source code is governed by MIT license that can be
 # found in the LICENSE file.
 
+import concurrent.futures
 import contextlib
 import errno
 import ftplib
+import functools
+import hashlib
 import io
 import logging
 import os
-import random
+import pathlib
 import re
 import select
+import shutil
 import socket
 import ssl
 import stat
 import struct
+import tempfile
+import threading
 import time
 from unittest.mock import patch
 
@@ -24,7 +30,6 @@ from pyftpdlib.filesystems import AbstractedFS
 from pyftpdlib.handlers import DTPHandler
 from pyftpdlib.handlers import FTPHandler
 from pyftpdlib.handlers import ThrottledDTPHandler
-from pyftpdlib.ioloop import IOLoop
 from pyftpdlib.servers import FTPServer
 from pyftpdlib.utils import has_dualstack_ipv6
 
@@ -36,13 +41,17 @@ from . import HOST
 from . import INTERRUPTED_TRANSF_SIZE
 from . import OSX
 from . import PASSWD
+from . import PAYLOAD_TIMES
 from . import POSIX
 from . import SUPPORTS_IPV4
 from . import SUPPORTS_IPV6
+from . import TESTFN_BASE_PREFIX
+from . import TESTFN_PREFIX
 from . import USER
 from . import WINDOWS
 from . import FtpdThreadWrapper
 from . import PyftpdlibTestCase
+from . import SharedServerTestCase
 from . import close_client
 from . import disable_log_warning
 from . import get_server_handler
@@ -50,8 +59,81 @@ from . import retry_on_failure
 from . import safe_rmpath
 from . import touch
 
+# the line separator files are stored with in ASCII mode
+LINESEP = os.linesep.encode("ascii")
 
-class TestFtpAuthentication(PyftpdlibTestCase):
+# SO_LINGER value (on, 0 secs timeout) causing close() to send a
+# connection reset (RST) instead of the standard FIN shutdown sequence
+SO_LINGER_RST = struct.pack("ii", 1, 0)
+
+
+@functools.lru_cache(maxsize=None)
+def get_payload(times, chunk=b"abcde12345"):
+    """Return chunk * times. The (possibly big) bytes object is built
+    once and shared across tests.
+    """
+    return chunk * times
+
+
+def digest(data):
+    """Return a blake2b digest of data, used to compare what was sent
+    with what was received.
+    """
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class HashWriter:
+    """A write-only file object which hashes (and counts) the data
+    written to it, instead of keeping it in memory.
+    """
+
+    def __init__(self):
+        self.hash = hashlib.blake2b(digest_size=16)
+        self.size = 0
+
+    def write(self, b):
+        self.hash.update(b)
+        self.size += len(b)
+        return len(b)
+
+    def digest(self):
+        return self.hash.digest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_payload_digest(times, chunk=b"abcde12345"):
+    """Return digest(get_payload(times, chunk))."""
+    return digest(get_payload(times, chunk))
+
+
+def pipeline(client, cmds):
+    """Send all commands at once, then read all their responses.
+    The server processes them in order as they are read from its
+    input buffer, so we pay a single round-trip instead of one per
+    command.
+    """
+    lines = "".join(cmd + "\r\n" for cmd in cmds)
+    client.sock.sendall(lines.encode(client.encoding))
+    return [client.getmultiline() for _ in cmds]
+
+
+def recv_line(sock, timeout=1):
+    """Receive a CRLF-terminated reply line from sock. Unlike a single
+    recv() call this does not break if the line arrives in more than
+    one TCP segment. Fails if nothing is received within timeout.
+    """
+    sock.settimeout(timeout)
+    buf = bytearray(BUFSIZE)
+    data = bytearray()
+    while not data.endswith(b"\r\n"):
+        n = sock.recv_into(buf)
+        if not n:
+            break
+        data += memoryview(buf)[:n]
+    return bytes(data)
+
+
+class TestFtpAuthentication(SharedServerTestCase):
     """Test: USER, PASS, REIN."""
 
     server_class = FtpdThreadWrapper
@@ -59,21 +141,12 @@ class TestFtpAuthentication(PyftpdlibTestCase):
 
     def setUp(self):
         super().setUp()
-        self.server = self.server_class()
-        self.server.start()
         self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
         self.client.connect(self.server.host, self.server.port)
         self.testfn = self.get_testfn()
-        self.file = open(self.testfn, "w+b")
-        self.dummyfile = io.BytesIO()
 
     def tearDown(self):
-        close_client(self.client)
-        self.server.stop()
-        if not self.file.closed:
-            self.file.close()
-        if not self.dummyfile.closed:
-            self.dummyfile.close()
+        close_client(self.client, quit=False)
         super().tearDown()
 
     def assert_auth_failed(self, user, passwd):
@@ -117,13 +190,13 @@ class TestFtpAuthentication(PyftpdlibTestCase):
         self.assert_auth_failed(USER, "wrong")
         self.assert_auth_failed(USER, "wrong")
         # If authentication fails for 3 times ftpd disconnects the
-        # client.  We can check if that happens by using self.client.sendcmd()
-        # on the 'dead' socket object.  If socket object is really
-        # closed it should be raised a OSError exception (Windows)
-        # or a EOFError exception (Linux).
-        self.client.sock.settimeout(0.1)
+        # client.  Wait for the socket to become readable, then check
+        # that the connection was closed: reading from it should raise
+        # OSError (Windows) or EOFError (Linux).
+        r, _, _ = select.select([self.client.sock], [], [], GLOBAL_TIMEOUT)
+        assert r, "server didn't disconnect the client"
         with pytest.raises((OSError, EOFError)):
-            self.client.sendcmd("")
+            self.client.getline()
 
     def test_rein(self):
         self.client.login(user=USER, passwd=PASSWD)
@@ -143,29 +216,28 @@ class TestFtpAuthentication(PyftpdlibTestCase):
         # Test REIN while already authenticated and a transfer is
         # in progress.
         self.client.login(user=USER, passwd=PASSWD)
-        data = b"abcde12345" * 1000000
-        self.file.write(data)
-        self.file.close()
+        data = get_payload(1000000)
+        pathlib.Path(self.testfn).write_bytes(data)
+        # received data is hashed as it comes in instead of being
+        # accumulated in memory
+        recv = HashWriter()
 
         conn = self.client.transfercmd("retr " + self.testfn)
         with contextlib.closing(conn):
-            rein_sent = False
-            bytes_recv = 0
-            while True:
+            while recv.size <= INTERRUPTED_TRANSF_SIZE:
                 chunk = conn.recv(BUFSIZE)
-                if not chunk:
-                    break
-                bytes_recv += len(chunk)
-                self.dummyfile.write(chunk)
-                if bytes_recv > INTERRUPTED_TRANSF_SIZE and not rein_sent:
-                    rein_sent = True
-                    # flush account, error response expected
-                    self.client.sendcmd("rein")
-                    with pytest.raises(
-                        ftplib.error_perm,
-                        match="530 Log in with USER and PASS first",
-                    ):
-                        self.client.dir()
+                assert chunk, "transfer finished too early"
+                recv.write(chunk)
+            # flush account, error response expected
+            self.client.sendcmd("rein")
+            with pytest.raises(
+                ftplib.error_perm,
+                match="530 Log in with USER and PASS first",
+            ):
+                self.client.dir()
+            # receive the rest of the file
+            with conn.makefile("rb") as f:
+                shutil.copyfileobj(f, recv)
 
         # a 226 response is expected once transfer finishes
         assert self.client.voidresp()[:3] == "226"
@@ -178,10 +250,8 @@ class TestFtpAuthentication(PyftpdlibTestCase):
         # filesystem command
         self.client.login(user=USER, passwd=PASSWD)
         self.client.sendcmd("pwd")
-        self.dummyfile.seek(0)
-        datafile = self.dummyfile.read()
-        assert len(data) == len(datafile)
-        assert hash(data) == hash(datafile)
+        assert recv.size == len(data)
+        assert recv.digest() == get_payload_digest(1000000)
 
     def test_user(self):
         # Test USER while already authenticated and no transfer
@@ -199,30 +269,27 @@ class TestFtpAuthentication(PyftpdlibTestCase):
         # Test USER while already authenticated and a transfer is
         # in progress.
         self.client.login(user=USER, passwd=PASSWD)
-        data = b"abcde12345" * 1000000
-        self.file.write(data)
-        self.file.close()
+        data = get_payload(1000000)
+        pathlib.Path(self.testfn).write_bytes(data)
+        recv = HashWriter()
 
         conn = self.client.transfercmd("retr " + self.testfn)
         with contextlib.closing(conn):
-            rein_sent = 0
-            bytes_recv = 0
-            while True:
+            # stop transfer while it isn't finished yet
+            while recv.size <= INTERRUPTED_TRANSF_SIZE:
                 chunk = conn.recv(BUFSIZE)
-                if not chunk:
-                    break
-                bytes_recv += len(chunk)
-                self.dummyfile.write(chunk)
-                # stop transfer while it isn't finished yet
-                if bytes_recv > INTERRUPTED_TRANSF_SIZE and not rein_sent:
-                    rein_sent = True
-                    # flush account, expect an error response
-                    self.client.sendcmd("user " + USER)
-                    with pytest.raises(
-                        ftplib.error_perm,
-                        match="530 Log in with USER and PASS first",
-                    ):
-                        self.client.dir()
+                assert chunk, "transfer finished too early"
+                recv.write(chunk)
+            # flush account, expect an error response
+            self.client.sendcmd("user " + USER)
+            with pytest.raises(
+                ftplib.error_perm,
+                match="530 Log in with USER and PASS first",
+            ):
+                self.client.dir()
+            # receive the rest of the file
+            with conn.makefile("rb") as f:
+                shutil.copyfileobj(f, recv)
 
             # a 226 response is expected once transfer finishes
             assert self.client.voidresp()[:3] == "226"
@@ -235,58 +302,61 @@ class TestFtpAuthentication(PyftpdlibTestCase):
             # filesystem command
             self.client.sendcmd("pass " + PASSWD)
             self.client.sendcmd("pwd")
-            self.dummyfile.seek(0)
-            datafile = self.dummyfile.read()
-            assert len(data) == len(datafile)
-            assert hash(data) == hash(datafile)
+            assert recv.size == len(data)
+            assert recv.digest() == get_payload_digest(1000000)
 
 
-class TestFtpDummyCmds(PyftpdlibTestCase):
+class TestFtpDummyCmds(SharedServerTestCase):
     """Test: TYPE, STRU, MODE, NOOP, SYST, ALLO, HELP, SITE HELP."""
 
     server_class = FtpdThreadWrapper
     client_class = ftplib.FTP
+    # matches the MLST line of the FEAT response
+    mlst_regex = re.compile(r"^\s*MLST\s+(\S+)$", re.MULTILINE)
 
     def setUp(self):
         super().setUp()
-        self.server = self.server_class()
-        self.server.start()
         self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
         self.client.connect(self.server.host, self.server.port)
         self.client.login(USER, PASSWD)
 
     def tearDown(self):
-        close_client(self.client)
-        self.server.stop()
+        close_client(self.client, quit=False)
         super().tearDown()
 
+    def assert_responses(self, *pairs):
+        # Pipeline all commands and match each response against the
+        # expected prefix.
+        cmds = [cmd for cmd, _ in pairs]
+        for (cmd, expected), resp in zip(pairs, pipeline(self.client, cmds)):
+            assert resp.startswith(expected), (cmd, resp)
+
     def test_type(self):
-        self.client.sendcmd("type a")
-        self.client.sendcmd("type i")
-        self.client.sendcmd("type l7")
-        self.client.sendcmd("type l8")
-        with pytest.raises(ftplib.error_perm, match="Unsupported type"):
-            self.client.sendcmd("type ?!?")
+        self.assert_responses(
+            ("type a", "200 "),
+            ("type i", "200 "),
+            ("type l7", "200 "),
+            ("type l8", "200 "),
+            ("type ?!?", "504 Unsupported type"),
+        )
 
     def test_stru(self):
-        self.client.sendcmd("stru f")
-        self.client.sendcmd("stru F")
-        with pytest.raises(ftplib.error_perm, match="Unimplemented"):
-            self.client.sendcmd("stru p")
-        with pytest.raises(ftplib.error_perm, match="Unimplemented"):
-            self.client.sendcmd("stru r")
-        with pytest.raises(ftplib.error_perm, match="Unrecognized"):
-            self.client.sendcmd("stru ?!?")
+        self.assert_responses(
+            ("stru f", "200 "),
+            ("stru F", "200 "),
+            ("stru p", "504 Unimplemented"),
+            ("stru r", "504 Unimplemented"),
+            ("stru ?!?", "501 Unrecognized"),
+        )
 
     def test_mode(self):
-        self.client.sendcmd("mode s")
-        self.client.sendcmd("mode S")
-        with pytest.raises(ftplib.error_perm, match="Unimplemented"):
-            self.client.sendcmd("mode b")
-        with pytest.raises(ftplib.error_perm, match="Unimplemented"):
-            self.client.sendcmd("mode c")
-        with pytest.raises(ftplib.error_perm, match="Unrecognized"):
-            self.client.sendcmd("mode ?!?")
+        self.assert_responses(
+            ("mode s", "200 "),
+            ("mode S", "200 "),
+            ("mode b", "504 Unimplemented"),
+            ("mode c", "504 Unimplemented"),
+            ("mode ?!?", "501 Unrecognized"),
+        )
 
     def test_noop(self):
         self.client.sendcmd("noop")
@@ -302,46 +372,40 @@ class TestFtpDummyCmds(PyftpdlibTestCase):
 
     def test_help(self):
         self.client.sendcmd("help")
-        cmd = random.choice(list(FTPHandler.proto_cmds.keys()))
-        self.client.sendcmd(f"help {cmd}")
+        cmds = [f"help {cmd}" for cmd in self.server.handler.proto_cmds]
+        for cmd, resp in zip(cmds, pipeline(self.client, cmds)):
+            assert resp.startswith("214 "), cmd
         with pytest.raises(ftplib.error_perm, match="Unrecognized"):
             self.client.sendcmd("help ?!?")
 
     def test_site(self):
-        with pytest.raises(ftplib.error_perm, match="needs an argument"):
-            self.client.sendcmd("site")
-        with pytest.raises(ftplib.error_perm, match="not understood"):
-            self.client.sendcmd("site ?!?")
-        with pytest.raises(ftplib.error_perm, match="not understood"):
-            self.client.sendcmd("site foo bar")
-        with pytest.raises(ftplib.error_perm, match="not understood"):
-            self.client.sendcmd("sitefoo bar")
+        self.assert_responses(
+            ("site", "501 Syntax error: command needs an argument"),
+            ("site ?!?", '500 Command "SITE ?!?" not understood'),
+            ("site foo bar", '500 Command "SITE FOO" not understood'),
+            ("sitefoo bar", '500 Command "SITEFOO" not understood'),
+        )
 
     def test_site_help(self):
-        self.client.sendcmd("site help")
-        self.client.sendcmd("site help help")
-        with pytest.raises(ftplib.error_perm, match="Unrecognized SITE"):
-            self.client.sendcmd("site help ?!?")
+        self.assert_responses(
+            ("site help", "214"),
+            ("site help help", "214 "),
+            ("site help ?!?", "501 Unrecognized SITE"),
+        )
 
     def test_rest(self):
         # Test error conditions only; resumed data transfers are
         # tested later.
-        self.client.sendcmd("type i")
-        with pytest.raises(ftplib.error_perm, match="needs an argument"):
-            self.client.sendcmd("rest")
-        with pytest.raises(ftplib.error_perm, match="Invalid parameter"):
-            self.client.sendcmd("rest str")
-        with pytest.raises(ftplib.error_perm, match="Invalid parameter"):
-            self.client.sendcmd("rest -1")
-
-        with pytest.raises(ftplib.error_perm, match="Invalid parameter"):
-            self.client.sendcmd("rest 10.1")
-        # REST is not supposed to be allowed in ASCII mode
-        self.client.sendcmd("type a")
-        with pytest.raises(
-            ftplib.error_perm, match="not allowed in ASCII mode"
-        ):
-            self.client.sendcmd("rest 10")
+        self.assert_responses(
+            ("type i", "200 "),
+            ("rest", "501 Syntax error: command needs an argument"),
+            ("rest str", "501 Invalid parameter"),
+            ("rest -1", "501 Invalid parameter"),
+            ("rest 10.1", "501 Invalid parameter"),
+            # REST is not supposed to be allowed in ASCII mode
+            ("type a", "200 "),
+            ("rest 10", "501 Resuming transfers not allowed in ASCII mode"),
+        )
 
     def test_feat(self):
         resp = self.client.sendcmd("feat")
@@ -362,7 +426,7 @@ class TestFtpDummyCmds(PyftpdlibTestCase):
 
         def mlst():
             resp = self.client.sendcmd("feat")
-            return re.search(r"^\s*MLST\s+(\S+)$", resp, re.MULTILINE).group(1)
+            return self.mlst_regex.search(resp).group(1)
 
         # we rely on "type", "perm", "size", and "modify" facts which
         # are those available on all platforms
@@ -383,7 +447,7 @@ class TestFtpDummyCmds(PyftpdlibTestCase):
         assert "type*;perm;size;modify;" in mlst()
 
 
-class TestFtpCmdsSemantic(PyftpdlibTestCase):
+class TestFtpCmdsSemantic(SharedServerTestCase):
     server_class = FtpdThreadWrapper
     client_class = ftplib.FTP
     arg_cmds = [
@@ -412,27 +476,41 @@ class TestFtpCmdsSemantic(PyftpdlibTestCase):
         "xmkd",
         "xrmd",
     ]
+    # commands which don't require the client to be authenticated
+    # (or that we don't test in test_auth_cmds)
+    no_auth_cmds = frozenset((
+        "feat",
+        "help",
+        "noop",
+        "user",
+        "pass",
+        "stat",
+        "syst",
+        "quit",
+        "site",
+        "site help",
+        "pbsz",
+        "auth",
+        "prot",
+        "ccc",
+    ))
 
     def setUp(self):
         super().setUp()
-        self.server = self.server_class()
-        self.server.start()
         self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
         self.client.connect(self.server.host, self.server.port)
         self.client.login(USER, PASSWD)
 
     def tearDown(self):
-        close_client(self.client)
-        self.server.stop()
+        close_client(self.client, quit=False)
         super().tearDown()
 
     def test_arg_cmds(self):
         # Test commands requiring an argument.
         expected = "501 Syntax error: command needs an argument."
-        for cmd in self.arg_cmds:
-            self.client.putcmd(cmd)
-            resp = self.client.getmultiline()
-            assert resp == expected
+        resps = pipeline(self.client, self.arg_cmds)
+        for cmd, resp in zip(self.arg_cmds, resps):
+            assert resp == expected, cmd
 
     def test_no_arg_cmds(self):
         # Test commands accepting no arguments.
@@ -450,39 +528,21 @@ class TestFtpCmdsSemantic(PyftpdlibTestCase):
             "xcup",
             "xpwd",
         ]
-        for cmd in narg_cmds:
-            self.client.putcmd(cmd + " arg")
-            resp = self.client.getmultiline()
-            assert resp == expected
+        cmds = [cmd + " arg" for cmd in narg_cmds]
+        for cmd, resp in zip(cmds, pipeline(self.client, cmds)):
+            assert resp == expected, cmd
 
     def test_auth_cmds(self):
         # Test those commands requiring client to be authenticated.
         expected = "530 Log in with USER and PASS first."
         self.client.sendcmd("rein")
-        for cmd in self.server.handler.proto_cmds:
-            cmd = cmd.lower()
-            if cmd in (
-                "feat",
-                "help",
-                "noop",
-                "user",
-                "pass",
-                "stat",
-                "syst",
-                "quit",
-                "site",
-                "site help",
-                "pbsz",
-                "auth",
-                "prot",
-                "ccc",
-            ):
-                continue
-            if cmd in self.arg_cmds:
-                cmd += " arg"
-            self.client.putcmd(cmd)
-            resp = self.client.getmultiline()
-            assert resp == expected
+        cmds = [
+            cmd + " arg" if cmd in self.arg_cmds else cmd
+            for cmd in map(str.lower, self.server.handler.proto_cmds)
+            if cmd not in self.no_auth_cmds
+        ]
+        for cmd, resp in zip(cmds, pipeline(self.client, cmds)):
+            assert resp == expected, cmd
 
     def test_no_auth_cmds(self):
         # Test those commands that do not require client to be authenticated.
@@ -496,7 +556,7 @@ class TestFtpCmdsSemantic(PyftpdlibTestCase):
         self.client.sendcmd("quit")
 
 
-class TestFtpFsOperations(PyftpdlibTestCase):
+class TestFtpFsOperations(SharedServerTestCase):
     """Test: PWD, CWD, CDUP, SIZE, RNFR, RNTO, DELE, MKD, RMD, MDTM,
     STAT, MFMT.
     """
@@ -506,22 +566,19 @@ class TestFtpFsOperations(PyftpdlibTestCase):
 
     def setUp(self):
         super().setUp()
-        self.server = self.server_class()
-        self.server.start()
         self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
         self.client.connect(self.server.host, self.server.port)
         self.client.login(USER, PASSWD)
+        # Tests create (only) what they need.
         self.tempfile = self.get_testfn()
         self.tempdir = self.get_testfn()
-        touch(self.tempfile)
-        os.mkdir(self.tempdir)
 
     def tearDown(self):
-        close_client(self.client)
-        self.server.stop()
+        close_client(self.client, quit=False)
         super().tearDown()
 
     def test_cwd(self):
+        os.mkdir(self.tempdir)
         self.client.cwd(self.tempdir)
         assert self.client.pwd() == "/" + self.tempdir
         with pytest.raises(ftplib.error_perm, match="No such file"):
@@ -532,11 +589,13 @@ class TestFtpFsOperations(PyftpdlibTestCase):
         assert self.client.pwd() == "/"
 
     def test_pwd(self):
+        os.mkdir(self.tempdir)
         assert self.client.pwd() == "/"
         self.client.cwd(self.tempdir)
         assert self.client.pwd() == "/" + self.tempdir
 
     def test_cdup(self):
+        os.mkdir(self.tempdir)
         subfolder = self.get_testfn(dir=self.tempdir)
         os.mkdir(os.path.join(self.tempdir, subfolder))
         assert self.client.pwd() == "/"
@@ -566,6 +625,8 @@ class TestFtpFsOperations(PyftpdlibTestCase):
             self.client.mkd(tempdir)
 
     def test_rmd(self):
+        touch(self.tempfile)
+        os.mkdir(self.tempdir)
         self.client.rmd(self.tempdir)
         with pytest.raises(ftplib.error_perm, match="Not a directory"):
             self.client.rmd(self.tempfile)
@@ -576,12 +637,16 @@ class TestFtpFsOperations(PyftpdlibTestCase):
             self.client.rmd("/")
 
     def test_dele(self):
+        touch(self.tempfile)
+        os.mkdir(self.tempdir)
         self.client.delete(self.tempfile)
         with pytest.raises(ftplib.error_perm):
             self.client.delete(self.tempdir)
 
     def test_rnfr_rnto(self):
         # rename file
+        touch(self.tempfile)
+        os.mkdir(self.tempdir)
         tempname = self.get_testfn()
         self.client.rename(self.tempfile, tempname)
         self.client.rename(tempname, self.tempfile)
@@ -605,6 +670,8 @@ class TestFtpFsOperations(PyftpdlibTestCase):
             self.client.rename("/", "/x")
 
     def test_mdtm(self):
+        touch(self.tempfile)
+        os.mkdir(self.tempdir)
         self.client.sendcmd("mdtm " + self.tempfile)
         bogus = self.get_testfn()
         with pytest.raises(ftplib.error_perm, match="not retrievable"):
@@ -615,6 +682,7 @@ class TestFtpFsOperations(PyftpdlibTestCase):
 
     def test_mfmt(self):
         # making sure MFMT is able to modify the timestamp for the file
+        touch(self.tempfile)
         test_timestamp = "20170921013410"
         self.client.sendcmd("mfmt " + test_timestamp + " " + self.tempfile)
         resp_time = os.path.getmtime(self.tempfile)
@@ -623,6 +691,7 @@ class TestFtpFsOperations(PyftpdlibTestCase):
 
     def test_invalid_mfmt_timeval(self):
         # testing MFMT with invalid timeval argument
+        touch(self.tempfile)
         test_timestamp_with_chars = "B017092101341A"
         test_timestamp_invalid_length = "20170921"
         with pytest.raises(ftplib.error_perm, match="Invalid time format"):
@@ -640,6 +709,8 @@ class TestFtpFsOperations(PyftpdlibTestCase):
             self.client.sendcmd("mfmt " + self.tempfile)
 
     def test_size(self):
+        touch(self.tempfile)
+        os.mkdir(self.tempdir)
         self.client.sendcmd("type a")
         with pytest.raises(
             ftplib.error_perm, match="SIZE not allowed in ASCII mode"
@@ -654,12 +725,14 @@ class TestFtpFsOperations(PyftpdlibTestCase):
     if not hasattr(os, "chmod"):
 
         def test_site_chmod(self):
+            touch(self.tempfile)
             with pytest.raises(ftplib.error_perm):
                 self.client.sendcmd("site chmod 777 " + self.tempfile)
 
     else:
 
         def test_site_chmod(self):
+            touch(self.tempfile)
             # not enough args
             with pytest.raises(ftplib.error_perm, match="needs two arguments"):
                 self.client.sendcmd("site chmod 777")
@@ -701,9 +774,9 @@ class TestFtpFsOperations(PyftpdlibTestCase):
 
 class CustomIO(io.RawIOBase):
 
-    def __init__(self):
+    def __init__(self, initial_bytes=b""):
         super().__init__()
-        self._bytesio = io.BytesIO()
+        self._bytesio = io.BytesIO(initial_bytes)
 
     def seek(self, offset, whence=io.SEEK_SET):
         return self._bytesio.seek(offset, whence)
@@ -714,132 +787,140 @@ class CustomIO(io.RawIOBase):
     def write(self, b):
         return self._bytesio.write(b)
 
+    def getvalue(self):
+        return self._bytesio.getvalue()
+
 
-class TestFtpStoreData(PyftpdlibTestCase):
+class TestFtpStoreData(SharedServerTestCase):
     """Test STOR, STOU, APPE, REST, TYPE."""
 
     server_class = FtpdThreadWrapper
     client_class = ftplib.FTP
     use_sendfile = None
     use_custom_io = False
+    use_tls = False
 
     def setUp(self):
         super().setUp()
-        self.server = self.server_class()
         if self.use_sendfile is not None:
             self.server.handler.use_sendfile = self.use_sendfile
-        self.server.start()
         self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
         self.client.connect(self.server.host, self.server.port)
         self.client.login(USER, PASSWD)
-        if self.use_custom_io:
-            self.dummy_recvfile = CustomIO()
-            self.dummy_sendfile = CustomIO()
-        else:
-            self.dummy_recvfile = io.BytesIO()
-            self.dummy_sendfile = io.BytesIO()
+        self.file_class = CustomIO if self.use_custom_io else io.BytesIO
+        self.dummy_recvfile = self.file_class()
+        self.dummy_sendfile = self.file_class()
         self.testfn = self.get_testfn()
 
     def tearDown(self):
-        close_client(self.client)
-        self.server.stop()
+        close_client(self.client, quit=False)
         self.dummy_recvfile.close()
         self.dummy_sendfile.close()
         if self.use_sendfile is not None:
             self.server.handler.use_sendfile = hasattr(os, "sendfile")
         super().tearDown()
 
+    def load_sendfile(self, data):
+        """Replace dummy_sendfile with a file object holding data.
+        A BytesIO shares data's buffer instead of copying it.
+        """
+        self.dummy_sendfile.close()
+        self.dummy_sendfile = self.file_class(data)
+
     def test_stor(self):
-        data = b"abcde12345" * 100000
-        self.dummy_sendfile.write(data)
-        self.dummy_sendfile.seek(0)
+        data = get_payload(PAYLOAD_TIMES)
+        self.load_sendfile(data)
         self.client.storbinary("stor " + self.testfn, self.dummy_sendfile)
         self.client.retrbinary(
             "retr " + self.testfn, self.dummy_recvfile.write
         )
-        self.dummy_recvfile.seek(0)
-        datafile = self.dummy_recvfile.read()
+        datafile = self.dummy_recvfile.getvalue()
         assert len(data) == len(datafile)
-        assert hash(data) == hash(datafile)
+        assert data == datafile
+
+    def test_stor_sendfile(self):
+        # Like test_stor but the client uploads a file on disk by
+        # using socket.sendfile() (zero-copy on POSIX).
+        data = get_payload(PAYLOAD_TIMES)
+        self.client.voidcmd("type i")
+        # The file doesn't need a name: on Linux this uses O_TMPFILE.
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            with contextlib.closing(
+                self.client.transfercmd("stor " + self.testfn)
+            ) as conn:
+                conn.sendfile(f)
+                if isinstance(conn, ssl.SSLSocket):
+                    conn.unwrap()
+        assert self.client.voidresp()[:3] == "226"
+        self.client.retrbinary(
+            "retr " + self.testfn, self.dummy_recvfile.write
+        )
+        datafile = self.dummy_recvfile.getvalue()
+        assert len(data) == len(datafile)
+        assert data == datafile
 
     def test_stor_active(self):
         # Like test_stor but using PORT
         self.client.set_pasv(False)
         self.test_stor()
 
+    def store_ascii(self, cmd, fp, blocksize=8192):
+        # like storbinary() except it sends "type a" instead of
+        # "type i" before starting the transfer
+        self.client.voidcmd("type a")
+        with contextlib.closing(self.client.transfercmd(cmd)) as conn:
+            while True:
+                buf = fp.read(blocksize)
+                if not buf:
+                    break
+                conn.sendall(buf)
+            if isinstance(conn, ssl.SSLSocket):
+                conn.unwrap()
+        return self.client.voidresp()
+
     @retry_on_failure
     def test_stor_ascii(self):
         # Test STOR in ASCII mode
-
-        def store(cmd, fp, blocksize=8192):
-            # like storbinary() except it sends "type a" instead of
-            # "type i" before starting the transfer
-            self.client.voidcmd("type a")
-            with contextlib.closing(self.client.transfercmd(cmd)) as conn:
-                while True:
-                    buf = fp.read(blocksize)
-                    if not buf:
-                        break
-                    conn.sendall(buf)
-                if isinstance(conn, ssl.SSLSocket):
-                    conn.unwrap()
-            return self.client.voidresp()
-
-        data = b"abcde12345\r\n" * 100000
-        self.dummy_sendfile.write(data)
-        self.dummy_sendfile.seek(0)
-        store("stor " + self.testfn, self.dummy_sendfile)
+        data = get_payload(PAYLOAD_TIMES, b"abcde12345\r\n")
+        self.load_sendfile(data)
+        self.store_ascii("stor " + self.testfn, self.dummy_sendfile)
         self.client.retrbinary(
             "retr " + self.testfn, self.dummy_recvfile.write
         )
-        expected = data.replace(b"\r\n", bytes(os.linesep, "ascii"))
-        self.dummy_recvfile.seek(0)
-        datafile = self.dummy_recvfile.read()
-        assert len(expected) == len(datafile)
-        assert hash(expected) == hash(datafile)
+        # CRLFs are expected to be stored as os.linesep
+        chunk = b"abcde12345" + LINESEP
+        datafile = self.dummy_recvfile.getvalue()
+        assert len(datafile) == PAYLOAD_TIMES * len(chunk)
+        assert datafile == get_payload(PAYLOAD_TIMES, chunk)
 
     @retry_on_failure
     def test_stor_ascii_2(self):
         # Test that no extra extra carriage returns are added to the
         # file in ASCII mode in case CRLF gets truncated in two chunks
         # (issue 116)
-
-        def store(cmd, fp, blocksize=8192):
-            # like storbinary() except it sends "type a" instead of
-            # "type i" before starting the transfer
-            self.client.voidcmd("type a")
-            with contextlib.closing(self.client.transfercmd(cmd)) as conn:
-                while True:
-                    buf = fp.read(blocksize)
-                    if not buf:
-                        break
-                    conn.sendall(buf)
-            return self.client.voidresp()
-
         old_buffer = DTPHandler.ac_in_buffer_size
         try:
             # set a small buffer so that CRLF gets delivered in two
             # separate chunks: "CRLF", " f", "oo", " CR", "LF", " b", "ar"
             DTPHandler.ac_in_buffer_size = 2
             data = b"\r\n foo \r\n bar"
-            self.dummy_sendfile.write(data)
-            self.dummy_sendfile.seek(0)
-            store("stor " + self.testfn, self.dummy_sendfile)
+            self.load_sendfile(data)
+            self.store_ascii("stor " + self.testfn, self.dummy_sendfile)
 
-            expected = data.replace(b"\r\n", bytes(os.linesep, "ascii"))
+            expected = data.replace(b"\r\n", LINESEP)
             self.client.retrbinary(
                 "retr " + self.testfn, self.dummy_recvfile.write
             )
             self.client.quit()
-            self.dummy_recvfile.seek(0)
-            assert expected == self.dummy_recvfile.read()
+            assert expected == self.dummy_recvfile.getvalue()
         finally:
             DTPHandler.ac_in_buffer_size = old_buffer
 
     def test_stou(self):
-        data = b"abcde12345" * 100000
-        self.dummy_sendfile.write(data)
-        self.dummy_sendfile.seek(0)
+        data = get_payload(PAYLOAD_TIMES)
+        self.load_sendfile(data)
 
         self.client.voidcmd("TYPE I")
         # filename comes in as "1xx FILE: <filename>"
@@ -849,22 +930,19 @@ class TestFtpStoreData(PyftpdlibTestCase):
                 conn, _ = sock.accept()
                 with contextlib.closing(conn):
                     conn.settimeout(GLOBAL_TIMEOUT)
-                    if hasattr(self.client_class, "ssl_version"):
+                    if self.use_tls:
                         conn = ssl.wrap_socket(conn)
-                    while True:
-                        buf = self.dummy_sendfile.read(8192)
-                        if not buf:
-                            break
-                        conn.sendall(buf)
+                    # in-memory files have no fileno() so this falls
+                    # back on send()ing the file content
+                    conn.sendfile(self.dummy_sendfile)
             # transfer finished, a 226 response is expected
             assert self.client.voidresp()[:3] == "226"
             self.client.retrbinary(
                 "retr " + filename, self.dummy_recvfile.write
             )
-            self.dummy_recvfile.seek(0)
-            datafile = self.dummy_recvfile.read()
+            datafile = self.dummy_recvfile.getvalue()
             assert len(data) == len(datafile)
-            assert hash(data) == hash(datafile)
+            assert data == datafile
         finally:
             # We do not use os.remove() because file could still be
             # locked by ftpd thread.  If DELE through FTP fails try
@@ -892,32 +970,27 @@ class TestFtpStoreData(PyftpdlibTestCase):
         # name we shouldn't get false positives.
         # login as a limited user in order to make STOU fail
         self.client.login("anonymous", "@nopasswd")
-        before = os.listdir(HOME)
+        before = set(os.listdir(HOME))
         with pytest.raises(ftplib.error_perm, match="Not enough privileges"):
             self.client.sendcmd("stou " + self.testfn)
-        after = os.listdir(HOME)
-        if before != after:
-            for file in after:
-                assert not file.startswith(self.testfn)
+        new = set(os.listdir(HOME)) - before
+        assert not [x for x in new if x.startswith(self.testfn)]
 
     def test_appe(self):
-        data1 = b"abcde12345" * 100000
-        self.dummy_sendfile.write(data1)
-        self.dummy_sendfile.seek(0)
+        data1 = get_payload(PAYLOAD_TIMES)
+        self.load_sendfile(data1)
         self.client.storbinary("stor " + self.testfn, self.dummy_sendfile)
 
-        data2 = b"fghil67890" * 100000
-        self.dummy_sendfile.write(data2)
-        self.dummy_sendfile.seek(len(data1))
+        data2 = get_payload(PAYLOAD_TIMES, b"fghil67890")
+        self.load_sendfile(data2)
         self.client.storbinary("appe " + self.testfn, self.dummy_sendfile)
 
         self.client.retrbinary(
             "retr " + self.testfn, self.dummy_recvfile.write
         )
-        self.dummy_recvfile.seek(0)
-        datafile = self.dummy_recvfile.read()
+        datafile = self.dummy_recvfile.getvalue()
         assert len(data1 + data2) == len(datafile)
-        assert hash(data1 + data2) == hash(datafile)
+        assert data1 + data2 == datafile
 
     def test_appe_rest(self):
         # Watch for APPE preceded by REST, which makes no sense.
@@ -928,22 +1001,17 @@ class TestFtpStoreData(PyftpdlibTestCase):
 
     def test_rest_on_stor(self):
         # Test STOR preceded by REST.
-        data = b"abcde12345" * 100000
-        self.dummy_sendfile.write(data)
-        self.dummy_sendfile.seek(0)
+        data = get_payload(PAYLOAD_TIMES)
+        self.load_sendfile(data)
 
         self.client.voidcmd("TYPE I")
         with contextlib.closing(
             self.client.transfercmd("stor " + self.testfn)
         ) as conn:
-            bytes_sent = 0
-            while True:
-                chunk = self.dummy_sendfile.read(BUFSIZE)
-                conn.sendall(chunk)
-                bytes_sent += len(chunk)
-                # stop transfer while it isn't finished yet
-                if bytes_sent >= INTERRUPTED_TRANSF_SIZE or not chunk:
-                    break
+            # stop transfer while it isn't finished yet
+            chunk = self.dummy_sendfile.read(INTERRUPTED_TRANSF_SIZE)
+            conn.sendall(chunk)
+            bytes_sent = len(chunk)
             if isinstance(conn, ssl.SSLSocket):
                 conn.unwrap()
 
@@ -964,13 +1032,9 @@ class TestFtpStoreData(PyftpdlibTestCase):
         self.client.retrbinary(
             "retr " + self.testfn, self.dummy_recvfile.write
         )
-        self.dummy_sendfile.seek(0)
-        self.dummy_recvfile.seek(0)
-
-        data_sendfile = self.dummy_sendfile.read()
-        data_recvfile = self.dummy_recvfile.read()
-        assert len(data_sendfile) == len(data_recvfile)
-        assert len(data_sendfile) == len(data_recvfile)
+        datafile = self.dummy_recvfile.getvalue()
+        assert len(data) == len(datafile)
+        assert data == datafile
 
     def test_failing_rest_on_stor(self):
         # Test REST -> STOR against a non existing file.
@@ -980,8 +1044,7 @@ class TestFtpStoreData(PyftpdlibTestCase):
             self.client.storbinary("stor " + self.testfn, lambda x: x)
         # if the first STOR failed because of REST, the REST marker
         # is supposed to be resetted to 0
-        self.dummy_sendfile.write(b"x" * 4096)
-        self.dummy_sendfile.seek(0)
+        self.load_sendfile(b"x" * 4096)
         self.client.storbinary("stor " + self.testfn, self.dummy_sendfile)
 
     def test_quit_during_transfer(self):
@@ -991,9 +1054,9 @@ class TestFtpStoreData(PyftpdlibTestCase):
         with contextlib.closing(
             self.client.transfercmd("stor " + self.testfn)
         ) as conn:
-            conn.sendall(b"abcde12345" * 50000)
+            conn.sendall(get_payload(50000))
             self.client.sendcmd("quit")
-            conn.sendall(b"abcde12345" * 50000)
+            conn.sendall(get_payload(50000))
         # expect the response (transfer ok)
         assert self.client.voidresp()[:3] == "226"
         # Make sure client has been disconnected.
@@ -1010,20 +1073,51 @@ class TestFtpStoreData(PyftpdlibTestCase):
             assert not f.read()
 
 
+class _StoreDataVariantMixin:
+    """Skips the TestFtpStoreData tests which are not affected by
+    use_sendfile / use_custom_io, as they don't move data from or to
+    the dummy files. TestFtpStoreData already runs them.
+    """
+
+    @pytest.mark.skip(reason="run by TestFtpStoreData only")
+    def test_stou_rest(self):
+        pass
+
+    @pytest.mark.skip(reason="run by TestFtpStoreData only")
+    def test_stou_orphaned_file(self):
+        pass
+
+    @pytest.mark.skip(reason="run by TestFtpStoreData only")
+    def test_appe_rest(self):
+        pass
+
+    @pytest.mark.skip(reason="run by TestFtpStoreData only")
+    def test_failing_rest_on_stor(self):
+        pass
+
+    @pytest.mark.skip(reason="run by TestFtpStoreData only")
+    def test_quit_during_transfer(self):
+        pass
+
+    @pytest.mark.skip(reason="run by TestFtpStoreData only")
+    def test_stor_empty_file(self):
+        pass
+
+
 @pytest.mark.skipif(not POSIX, reason="POSIX only")
-class TestFtpStoreDataNoSendfile(TestFtpStoreData):
+class TestFtpStoreDataNoSendfile(_StoreDataVariantMixin, TestFtpStoreData):
     """Test STOR, STOU, APPE, REST, TYPE not using sendfile()."""
 
     use_sendfile = False
 
 
-class TestFtpStoreDataWithCustomIO(TestFtpStoreData):
+class TestFtpStoreDataWithCustomIO(_StoreDataVariantMixin, TestFtpStoreData):
     """Test STOR, STOU, APPE, REST, TYPE with custom IO objects()."""
 
     use_custom_io = True
 
 
-class TestFtpRetrieveData(PyftpdlibTestCase):
+class TestFtpRetrieveData(SharedServerTestCase):
     """Test RETR, REST, TYPE."""
 
     server_class = FtpdThreadWrapper
@@ -1032,23 +1126,24 @@ class TestFtpRetrieveData(PyftpdlibTestCase):
     use_custom_io = False
 
     def retrieve_ascii(self, cmd, callback, blocksize=8192, rest=None):
-        """Like retrbinary but uses TYPE A instead."""
+        """Like retrbinary but uses TYPE A instead. callback gets a
+        memoryview which is only valid until it returns.
+        """
         self.client.voidcmd("type a")
         with contextlib.closing(self.client.transfercmd(cmd, rest)) as conn:
             conn.settimeout(GLOBAL_TIMEOUT)
+            buf = memoryview(bytearray(blocksize))
             while True:
-                data = conn.recv(blocksize)
-                if not data:
+                n = conn.recv_into(buf)
+                if not n:
                     break
-                callback(data)
+                callback(buf[:n])
         return self.client.voidresp()
 
     def setUp(self):
         super().setUp()
-        self.server = self.server_class()
         if self.use_sendfile is not None:
             self.server.handler.use_sendfile = self.use_sendfile
-        self.server.start()
         self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
         self.client.connect(self.server.host, self.server.port)
         self.client.login(USER, PASSWD)
@@ -1059,22 +1154,19 @@ class TestFtpRetrieveData(PyftpdlibTestCase):
             self.dummyfile = io.BytesIO()
 
     def tearDown(self):
-        close_client(self.client)
-        self.server.stop()
+        close_client(self.client, quit=False)
         self.dummyfile.close()
         if self.use_sendfile is not None:
             self.server.handler.use_sendfile = hasattr(os, "sendfile")
         super().tearDown()
 
     def test_retr(self):
-        data = b"abcde12345" * 100000
-        with open(self.testfn, "wb") as f:
-            f.write(data)
+        data = get_payload(PAYLOAD_TIMES)
+        pathlib.Path(self.testfn).write_bytes(data)
         self.client.retrbinary("retr " + self.testfn, self.dummyfile.write)
-        self.dummyfile.seek(0)
-        datafile = self.dummyfile.read()
+        datafile = self.dummyfile.getvalue()
         assert len(data) == len(datafile)
-        assert hash(data) == hash(datafile)
+        assert data == datafile
 
         # attempt to retrieve a file which doesn't exist
         bogus = self.get_testfn()
@@ -1083,46 +1175,41 @@ class TestFtpRetrieveData(PyftpdlibTestCase):
 
     def test_retr_ascii(self):
         # Test RETR in ASCII mode.
-        data = (b"abcde12345" + bytes(os.linesep, "ascii")) * 100000
-        with open(self.testfn, "wb") as f:
-            f.write(data)
+        data = get_payload(PAYLOAD_TIMES, b"abcde12345" + LINESEP)
+        pathlib.Path(self.testfn).write_bytes(data)
         self.retrieve_ascii("retr " + self.testfn, self.dummyfile.write)
-        expected = data.replace(bytes(os.linesep, "ascii"), b"\r\n")
-        self.dummyfile.seek(0)
-        datafile = self.dummyfile.read()
+        expected = data.replace(LINESEP, b"\r\n")
+        datafile = self.dummyfile.getvalue()
         assert len(expected) == len(datafile)
-        assert hash(expected) == hash(datafile)
+        assert expected == datafile
 
     def test_retr_ascii_already_crlf(self):
         # Test ASCII mode RETR for data with CRLF line endings.
-        data = b"abcde12345\r\n" * 100000
-        with open(self.testfn, "wb") as f:
-            f.write(data)
+        data = get_payload(PAYLOAD_TIMES, b"abcde12345\r\n")
+        pathlib.Path(self.testfn).write_bytes(data)
         self.retrieve_ascii("retr " + self.testfn, self.dummyfile.write)
-        self.dummyfile.seek(0)
-        datafile = self.dummyfile.read()
+        datafile = self.dummyfile.getvalue()
         assert len(data) == len(datafile)
-        assert hash(data) == hash(datafile)
+        assert data == datafile
 
     @retry_on_failure
     def test_restore_on_retr(self):
-        data = b"abcde12345" * 1000000
-        with open(self.testfn, "wb") as f:
-            f.write(data)
+        pathlib.Path(self.testfn).write_bytes(get_payload(1000000))
 
-        received_bytes = 0
+        # 10 MB are received: don't keep them in memory
+        recv = HashWriter()
         self.client.voidcmd("TYPE I")
         with contextlib.closing(
             self.client.transfercmd("retr " + self.testfn)
         ) as conn:
             conn.settimeout(GLOBAL_TIMEOUT)
+            buf = memoryview(bytearray(BUFSIZE))
             while True:
-                chunk = conn.recv(BUFSIZE)
-                if not chunk:
+                n = conn.recv_into(buf)
+                if not n:
                     break
-                self.dummyfile.write(chunk)
-                received_bytes += len(chunk)
-                if received_bytes >= INTERRUPTED_TRANSF_SIZE:
+                recv.write(buf[:n])
+                if recv.size >= INTERRUPTED_TRANSF_SIZE:
                     break
 
         # transfer wasn't finished yet so we expect a 426 response
@@ -1138,18 +1225,15 @@ class TestFtpRetrieveData(PyftpdlibTestCase):
         ):
             self.client.sendcmd("retr " + self.testfn)
         # test resume
-        self.client.sendcmd(f"rest {received_bytes}")
-        self.client.retrbinary("retr " + self.testfn, self.dummyfile.write)
-        self.dummyfile.seek(0)
-        datafile = self.dummyfile.read()
-        assert len(data) == len(datafile)
-        assert hash(data) == hash(datafile)
+        self.client.sendcmd(f"rest {recv.size}")
+        self.client.retrbinary("retr " + self.testfn, recv.write)
+        assert recv.size == len(get_payload(1000000))
+        assert recv.digest() == get_payload_digest(1000000)
 
     def test_retr_empty_file(self):
         touch(self.testfn)
         self.client.retrbinary("retr " + self.testfn, self.dummyfile.write)
-        self.dummyfile.seek(0)
-        assert self.dummyfile.read() == b""
+        assert self.dummyfile.getvalue() == b""
 
 
 @pytest.mark.skipif(not POSIX, reason="POSIX only")
@@ -1165,7 +1249,7 @@ class TestFtpRetrieveDataCustomIO(TestFtpRetrieveData):
     use_custom_io = True
 
 
-class TestFtpListingCmds(PyftpdlibTestCase):
+class TestFtpListingCmds(SharedServerTestCase):
     """Test LIST, NLST, argumented STAT."""
 
     server_class = FtpdThreadWrapper
@@ -1173,8 +1257,6 @@ class TestFtpListingCmds(PyftpdlibTestCase):
 
     def setUp(self):
         super().setUp()
-        self.server = self.server_class()
-        self.server.start()
         self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
         self.client.connect(self.server.host, self.server.port)
         self.client.login(USER, PASSWD)
@@ -1182,17 +1264,26 @@ class TestFtpListingCmds(PyftpdlibTestCase):
         touch(self.testfn)
 
     def tearDown(self):
-        close_client(self.client)
-        self.server.stop()
+        close_client(self.client, quit=False)
         super().tearDown()
 
+    def retrlines(self, cmd):
+        """Return the lines returned by a listing command, except for
+        the test files of other processes, which tests running in
+        parallel (`make test-parallel`) may create or remove meanwhile.
+        """
+        lines = []
+        self.client.retrlines(cmd, lines.append)
+        return [
+            x
+            for x in lines
+            if TESTFN_BASE_PREFIX not in x or TESTFN_PREFIX in x
+        ]
+
     def _test_listing_cmds(self, cmd):
         """Tests common to LIST NLST and MLSD commands."""
         # assume that no argument has the same meaning of "/"
-        l1 = l2 = []
-        self.client.retrlines(cmd, l1.append)
-        self.client.retrlines(cmd + " /", l2.append)
-        assert l1 == l2
+        assert self.retrlines(cmd) == self.retrlines(cmd + " /")
         if cmd.lower() != "mlsd":
             # if pathname is a file one line is expected
             x = []
@@ -1225,15 +1316,11 @@ class TestFtpListingCmds(PyftpdlibTestCase):
         self._test_listing_cmds("list")
         # known incorrect pathname arguments (e.g. old clients) are
         # expected to be treated as if pathname would be == '/'
-        l1 = l2 = l3 = l4 = l5 = []
-        self.client.retrlines("list /", l1.append)
-        self.client.retrlines("list -a", l2.append)
-        self.client.retrlines("list -l", l3.append)
-        self.client.retrlines("list -al", l4.append)
-        self.client.retrlines("list -la", l5.append)
-        tot = (l1, l2, l3, l4, l5)
-        for x in range(len(tot) - 1):
-            assert tot[x] == tot[x + 1]
+        cmds = ("list /", "list -a", "list -l", "list -al", "list -la")
+        listings = [self.retrlines(cmd) for cmd in cmds]
+        assert listings[0]
+        for lines in listings[1:]:
+            assert lines == listings[0]
 
     def test_mlst(self):
         # utility function for extracting the line of interest
@@ -1279,10 +1366,15 @@ class TestFtpListingCmds(PyftpdlibTestCase):
     def test_mlsd_all_facts(self):
         feat = self.client.sendcmd("feat")
         # all the facts
-        facts = re.search(r"^\s*MLST\s+(\S+)$", feat, re.MULTILINE).group(1)
+        line = next(
+            x for x in feat.splitlines() if x.lstrip().startswith("MLST ")
+        )
+        facts = line.split()[1]
         facts = facts.replace("*;", ";")
-        self.client.sendcmd("opts mlst " + facts)
-        resp = self.client.sendcmd("mlst")
+        # OPTS needs FEAT's response, MLST can be pipelined with it
+        opts, resp = pipeline(self.client, ["opts mlst " + facts, "mlst"])
+        assert opts.startswith("200 ")
+        assert resp.startswith("250-")
 
         local = facts[:-1].split(";")
         returned = resp.split("\n")[1].strip()[:-3]
@@ -1332,7 +1424,7 @@ class TestFtpListingCmds(PyftpdlibTestCase):
             AbstractedFS.getmtime = getmtime
 
 
-class TestFtpAbort(PyftpdlibTestCase):
+class TestFtpAbort(SharedServerTestCase):
     """Test: ABOR."""
 
     server_class = FtpdThreadWrapper
@@ -1340,15 +1432,12 @@ class TestFtpAbort(PyftpdlibTestCase):
 
     def setUp(self):
         super().setUp()
-        self.server = self.server_class()
-        self.server.start()
         self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
         self.client.connect(self.server.host, self.server.port)
         self.client.login(USER, PASSWD)
 
     def tearDown(self):
-        close_client(self.client)
-        self.server.stop()
+        close_client(self.client, quit=False)
         super().tearDown()
 
     def test_abor_no_data(self):
@@ -1380,18 +1469,17 @@ class TestFtpAbort(PyftpdlibTestCase):
         # Case 4: ABOR while a data transfer on DTP channel is in
         # progress: close data channel, respond with 426, respond
         # with 226.
-        data = b"abcde12345" * 1000000
+        data = get_payload(1000000)
         testfn = self.get_testfn()
-        with open(testfn, "w+b") as f:
-            f.write(data)
+        pathlib.Path(testfn).write_bytes(data)
         self.client.voidcmd("TYPE I")
         with contextlib.closing(
             self.client.transfercmd("retr " + testfn)
         ) as conn:
+            buf = bytearray(BUFSIZE)
             bytes_recv = 0
             while bytes_recv < 65536:
-                chunk = conn.recv(BUFSIZE)
-                bytes_recv += len(chunk)
+                bytes_recv += conn.recv_into(buf)
 
             # stop transfer while it isn't finished yet
             self.client.putcmd("ABOR")
@@ -1467,21 +1555,19 @@ class TestThrottleBandwidth(PyftpdlibTestCase):
         # awakes all that code which implements the throttling.
         # with self.server.lock:
         self.server.handler.dtp_handler.write_limit = 32768
-        data = b"abcde12345" * 100000
-        with open(self.testfn, "wb") as file:
-            file.write(data)
+        data = get_payload(PAYLOAD_TIMES)
+        pathlib.Path(self.testfn).write_bytes(data)
         self.client.retrbinary("retr " + self.testfn, self.dummyfile.write)
-        self.dummyfile.seek(0)
-        datafile = self.dummyfile.read()
+        datafile = self.dummyfile.getvalue()
         assert len(data) == len(datafile)
-        assert hash(data) == hash(datafile)
+        assert data == datafile
 
     def test_throttle_recv(self):
         # This test doesn't test the actual speed accuracy, just
         # awakes all that code which implements the throttling.
         # with self.server.lock:
         self.server.handler.dtp_handler.read_limit = 32768
-        data = b"abcde12345" * 100000
+        data = get_payload(PAYLOAD_TIMES)
         self.dummyfile.write(data)
         self.dummyfile.seek(0)
         self.client.storbinary("stor " + self.testfn, self.dummyfile)
@@ -1489,7 +1575,7 @@ class TestThrottleBandwidth(PyftpdlibTestCase):
         with open(self.testfn, "rb") as file:
             file_data = file.read()
         assert len(data) == len(file_data)
-        assert hash(data) == hash(file_data)
+        assert data == file_data
 
 
 class TestTimeouts(PyftpdlibTestCase):
@@ -1499,6 +1585,7 @@ class TestTimeouts(PyftpdlibTestCase):
 
     server_class = FtpdThreadWrapper
     client_class = ftplib.FTP
+    use_tls = False
 
     def setUp(self):
         super().setUp()
@@ -1554,12 +1641,11 @@ class TestTimeouts(PyftpdlibTestCase):
         # DTPHandler.timeout is supposed to be kicked off.
         self._setUp(data_timeout=0.5 if CI_TESTING else 0.1)
         addr = self.client.makepasv()
-        with contextlib.closing(socket.socket()) as s:
+        with socket.socket() as s:
             s.settimeout(GLOBAL_TIMEOUT)
             s.connect(addr)
             # fail if no msg is received within 1 second
-            self.client.sock.settimeout(1)
-            data = self.client.sock.recv(BUFSIZE)
+            data = recv_line(self.client.sock)
             assert data == b"421 Data connection timed out.\r\n"
             # ensure client has been kicked off
             with pytest.raises((OSError, EOFError)):
@@ -1573,7 +1659,7 @@ class TestTimeouts(PyftpdlibTestCase):
         with contextlib.closing(
             self.client.transfercmd("stor " + self.testfn)
         ) as sock:
-            if hasattr(self.client_class, "ssl_version"):
+            if self.use_tls:
                 sock = ssl.wrap_socket(sock)
             stop_at = time.time() + 0.2
             while time.time() < stop_at:
@@ -1581,44 +1667,40 @@ class TestTimeouts(PyftpdlibTestCase):
             sock.close()
             self.client.voidresp()
 
-    def test_idle_data_timeout1(self):
-        # Tests that the control connection timeout is suspended while
-        # the data channel is opened
+    def test_idle_data_timeout(self):
+        # Both checks use the same timeouts, so they share one server
+        # and run side by side on two sessions, overlapping their waits:
+        # 1) the control connection timeout is suspended while the
+        #    data channel is opened;
+        # 2) the control connection timeout is restarted after the data
+        #    channel has been closed.
         self._setUp(
             idle_timeout=0.5 if CI_TESTING else 0.1,
             data_timeout=0.6 if CI_TESTING else 0.2,
         )
+        client2 = self.client_class(timeout=GLOBAL_TIMEOUT)
+        self.addCleanup(close_client, client2)
+        client2.connect(self.server.host, self.server.port)
+        client2.login(USER, PASSWD)
         addr = self.client.makepasv()
-        with contextlib.closing(socket.socket()) as s:
+        addr2 = client2.makepasv()
+        with socket.socket() as s, socket.socket() as s2:
             s.settimeout(GLOBAL_TIMEOUT)
             s.connect(addr)
+            s2.settimeout(GLOBAL_TIMEOUT)
+            s2.connect(addr2)
+            # close data channel of the second session
+            client2.sendcmd("abor")
             # fail if no msg is received within 1 second
-            self.client.sock.settimeout(1)
-            data = self.client.sock.recv(BUFSIZE)
+            data = recv_line(self.client.sock)
             assert data == b"421 Data connection timed out.\r\n"
-            # ensure client has been kicked off
-            with pytest.raises((OSError, EOFError)):
-                self.client.sendcmd("noop")
-
-    def test_idle_data_timeout2(self):
-        # Tests that the control connection timeout is restarted after
-        # data channel has been closed
-        self._setUp(
-            idle_timeout=0.5 if CI_TESTING else 0.1,
-            data_timeout=0.6 if CI_TESTING else 0.2,
-        )
-        addr = self.client.makepasv()
-        with contextlib.closing(socket.socket()) as s:
-            s.settimeout(GLOBAL_TIMEOUT)
-            s.connect(addr)
-            # close data channel
-            self.client.sendcmd("abor")
-            self.client.sock.settimeout(1)
-            data = self.client.sock.recv(BUFSIZE)
+            data = recv_line(client2.sock)
             assert data == b"421 Control connection timed out.\r\n"
-            # ensure client has been kicked off
+            # ensure both clients have been kicked off
             with pytest.raises((OSError, EOFError)):
                 self.client.sendcmd("noop")
+            with pytest.raises((OSError, EOFError)):
+                client2.sendcmd("noop")
 
     def test_pasv_timeout(self):
         # Test pasv data channel timeout.  The client which does not
@@ -1627,40 +1709,38 @@ class TestTimeouts(PyftpdlibTestCase):
         self._setUp(pasv_timeout=0.5 if CI_TESTING else 0.1)
         self.client.makepasv()
         # fail if no msg is received within 1 second
-        self.client.sock.settimeout(1)
-        data = self.client.sock.recv(BUFSIZE)
+        data = recv_line(self.client.sock)
         assert data == b"421 Passive data channel timed out.\r\n"
         # client is not expected to be kicked off
         self.client.sendcmd("noop")
 
-    def test_disabled_idle_timeout(self):
-        self._setUp(idle_timeout=0)
+    def test_disabled_timeouts(self):
+        # A timeout of 0 disables it. The four timeouts are orthogonal
+        # so they're all checked against the same server.
+        self._setUp(
+            idle_timeout=0, data_timeout=0, pasv_timeout=0, port_timeout=0
+        )
+        # idle timeout
         self.client.sendcmd("noop")
-
-    def test_disabled_data_timeout(self):
-        self._setUp(data_timeout=0)
+        # data timeout
         addr = self.client.makepasv()
-        with contextlib.closing(socket.socket()) as s:
+        with socket.socket() as s:
             s.settimeout(GLOBAL_TIMEOUT)
             s.connect(addr)
-
-    def test_disabled_pasv_timeout(self):
-        self._setUp(pasv_timeout=0)
+        # pasv timeout
         self.client.makepasv()
         # reset passive socket
         addr = self.client.makepasv()
-        with contextlib.closing(socket.socket()) as s:
+        with socket.socket() as s:
             s.settimeout(GLOBAL_TIMEOUT)
             s.connect(addr)
-
-    def test_disabled_port_timeout(self):
-        self._setUp(port_timeout=0)
+        # port timeout
         with contextlib.closing(self.client.makeport()):
             with contextlib.closing(self.client.makeport()):
                 pass
 
 
-class TestConfigurableOptions(PyftpdlibTestCase):
+class TestConfigurableOptions(SharedServerTestCase):
     """Test those daemon options which are commonly modified by user."""
 
     server_class = FtpdThreadWrapper
@@ -1668,7 +1748,6 @@ class TestConfigurableOptions(PyftpdlibTestCase):
 
     def setUp(self):
         super().setUp()
-        self.server = None
         self.client = None
 
     def connect(self):
@@ -1678,31 +1757,17 @@ class TestConfigurableOptions(PyftpdlibTestCase):
 
     def tearDown(self):
         if self.client is not None:
-            close_client(self.client)
-        # set back options to their original value
-        if self.server is not None:
-            self.server.server.max_cons = 0
-            self.server.server.max_cons_per_ip = 0
-            self.server.handler.banner = "pyftpdlib ready."
-            self.server.handler.max_login_attempts = 3
-            self.server.handler.auth_failed_timeout = 5
-            self.server.handler.masquerade_address = None
-            self.server.handler.masquerade_address_map = {}
-            self.server.handler.permit_privileged_ports = False
-            self.server.handler.permit_foreign_addresses = False
-            self.server.handler.passive_ports = None
-            self.server.handler.use_gmt_times = True
-            self.server.handler.tcp_no_delay = hasattr(socket, "TCP_NODELAY")
-            self.server.handler.encoding = "utf8"
-            self.server.stop()
+            close_client(self.client, quit=False)
+        # set back options to their original value (handler options
+        # are reset by reset_server_opts() in setUp())
+        self.server.server.max_cons = 0
+        self.server.server.max_cons_per_ip = 0
         super().tearDown()
 
     @disable_log_warning
     def test_max_connections(self):
         # Test FTPServer.max_cons attribute
-        self.server = self.server_class()
         self.server.server.max_cons = 3
-        self.server.start()
 
         c1 = self.client_class()
         c2 = self.client_class()
@@ -1755,21 +1820,15 @@ class TestConfigurableOptions(PyftpdlibTestCase):
                         self.server.port,
                     )
         finally:
+            # No need to QUIT (one round-trip each): tearDown() waits
+            # for the server to dispose of the dropped connections.
             for c in (c1, c2, c3):
-                try:
-                    c.quit()
-                except (OSError, EOFError, ftplib.Error):
-                    # already disconnected
-                    pass
-                finally:
-                    c.close()
+                close_client(c, quit=False)
 
     @disable_log_warning
     def test_max_connections_per_ip(self):
         # Test FTPServer.max_cons_per_ip attribute
-        self.server = self.server_class()
         self.server.server.max_cons_per_ip = 3
-        self.server.start()
 
         c1 = self.client_class()
         c2 = self.client_class()
@@ -1794,26 +1853,19 @@ class TestConfigurableOptions(PyftpdlibTestCase):
                 c4.sendcmd("noop")
         finally:
             for c in (c1, c2, c3, c4):
-                try:
-                    c.quit()
-                except (OSError, EOFError):  # already disconnected
-                    c.close()
+                close_client(c, quit=False)
 
     def test_banner(self):
         # Test FTPHandler.banner attribute
-        self.server = self.server_class()
         self.server.handler.banner = "hello there"
-        self.server.start()
         self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
         self.client.connect(self.server.host, self.server.port)
         assert self.client.getwelcome()[4:] == "hello there"
 
     def test_max_login_attempts(self):
         # Test FTPHandler.max_login_attempts attribute.
-        self.server = self.server_class()
         self.server.handler.max_login_attempts = 1
         self.server.handler.auth_failed_timeout = 0
-        self.server.start()
         self.connect()
         with pytest.raises(ftplib.error_perm):
             self.client.login("wrong", "wrong")
@@ -1824,51 +1876,57 @@ class TestConfigurableOptions(PyftpdlibTestCase):
         with pytest.raises((OSError, EOFError)):
             self.client.sendcmd("noop")
 
+
+class TestConfigurableHandlerOptions(SharedServerTestCase):
+    """Test those handler options which are looked up every time a
+    command is processed, hence can be changed on the fly by an already
+    logged in client.
+    """
+
+    server_class = FtpdThreadWrapper
+    client_class = ftplib.FTP
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.client_class(timeout=GLOBAL_TIMEOUT)
+        self.client.connect(self.server.host, self.server.port)
+        self.client.login(USER, PASSWD)
+
+    def tearDown(self):
+        close_client(self.client, quit=False)
+        super().tearDown()
+
     def test_masquerade_address(self):
         # Test FTPHandler.masquerade_address attribute
-        self.server = self.server_class()
         self.server.handler.masquerade_address = "256.256.256.256"
-        self.server.start()
-        self.connect()
         host = ftplib.parse227(self.client.sendcmd("PASV"))[0]
         assert host == "256.256.256.256"
 
     def test_masquerade_address_map(self):
         # Test FTPHandler.masquerade_address_map attribute
-        self.server = self.server_class()
         self.server.handler.masquerade_address_map = {
             self.server.host: "128.128.128.128"
         }
-        self.server.start()
-        self.connect()
         host = ftplib.parse227(self.client.sendcmd("PASV"))[0]
         assert host == "128.128.128.128"
 
     def test_passive_ports(self):
         # Test FTPHandler.passive_ports attribute
-        self.server = self.server_class()
-        range_ = list(range(40000, 60000, 200))
+        range_ = range(40000, 60000, 200)
         self.server.handler.passive_ports = range_
-        self.server.start()
-        self.connect()
-        assert self.client.makepasv()[1] in range_
-        assert self.client.makepasv()[1] in range_
-        assert self.client.makepasv()[1] in range_
-        assert self.client.makepasv()[1] in range_
+        ports = [self.client.makepasv()[1] for _ in range(4)]
+        assert all(port in range_ for port in ports), ports
 
     @disable_log_warning
     def test_passive_ports_busy(self):
         # If the ports in the configured range are busy it is expected
         # that a kernel-assigned port gets chosen
 
-        with contextlib.closing(socket.socket()) as s:
+        with socket.socket() as s:
             s.settimeout(GLOBAL_TIMEOUT)
             s.bind((HOST, 0))
             port = s.getsockname()[1]
-            self.server = self.server_class()
             self.server.handler.passive_ports = [port]
-            self.server.start()
-            self.connect()
             resulting_port = self.client.makepasv()[1]
             assert port != resulting_port
 
@@ -1876,25 +1934,16 @@ class TestConfigurableOptions(PyftpdlibTestCase):
     def test_use_gmt_times(self):
         testfn = self.get_testfn()
         touch(testfn)
+        cmds = ["mdtm " + testfn, "mlst " + testfn, "stat " + testfn]
         # use GMT time
-        self.server = self.server_class()
         self.server.handler.use_gmt_times = True
-        self.server.start()
-        self.connect()
-        gmt1 = self.client.sendcmd("mdtm " + testfn)
-        gmt2 = self.client.sendcmd("mlst " + testfn)
-        gmt3 = self.client.sendcmd("stat " + testfn)
+        gmt1, gmt2, gmt3 = pipeline(self.client, cmds)
+        assert [x[:4] for x in (gmt1, gmt2, gmt3)] == ["213 ", "250-", "213-"]
 
         # use local time
-        self.tearDown()
-        self.setUp()
-        self.server = self.server_class()
         self.server.handler.use_gmt_times = False
-        self.server.start()
-        self.connect()
-        loc1 = self.client.sendcmd("mdtm " + testfn)
-        loc2 = self.client.sendcmd("mlst " + testfn)
-        loc3 = self.client.sendcmd("stat " + testfn)
+        loc1, loc2, loc3 = pipeline(self.client, cmds)
+        assert [x[:4] for x in (loc1, loc2, loc3)] == ["213 ", "250-", "213-"]
 
         # if we're not in a GMT time zone times are supposed to be
         # different
@@ -1911,18 +1960,16 @@ class TestConfigurableOptions(PyftpdlibTestCase):
     def test_encoding(self):
         # Make sure that if encoding != UTF-8, FEAT command does not
         # list UTF-8.
-        self.server = self.server_class()
         self.server.handler.encoding = "latin-1"
-        self.server.start()
-        self.connect()
         resp = self.client.sendcmd("feat")
         assert "UTF8" not in resp
 
 
-@pytest.mark.xdist_group(name="serial")
 class TestCallbacks(PyftpdlibTestCase):
     server_class = FtpdThreadWrapper
     client_class = ftplib.FTP
+    # what's logged once the client is connected and logged in
+    _PREFIX = f"on_connect,on_login:{USER},"
 
     def setUp(self):
         super().setUp()
@@ -1932,6 +1979,7 @@ class TestCallbacks(PyftpdlibTestCase):
             def write(self, text):
                 with open(testfn, "a") as f:
                     f.write(text)
+                written.set()
 
             def on_connect(self):
                 self.write("on_connect,")
@@ -1964,6 +2012,7 @@ class TestCallbacks(PyftpdlibTestCase):
                     f"on_incomplete_file_received:{os.path.basename(file)},"
                 )
 
+        self.written = written = threading.Event()
         self.testfn = testfn = self.get_testfn()
         self.testfn2 = self.get_testfn()
         self.server = self.server_class()
@@ -1978,31 +2027,34 @@ class TestCallbacks(PyftpdlibTestCase):
         super().tearDown()
 
     def read_file(self, text):
-        stop_at = time.time() + 1
-        while time.time() <= stop_at:
+        # Callbacks are fired by the server thread, which sets the
+        # `written` event every time it appends to the file. Clear it
+        # before reading so that a write racing with us wakes us up.
+        stop_at = time.monotonic() + 1
+        while True:
+            self.written.clear()
             with open(self.testfn) as f:
                 data = f.read()
-                if data == text:
-                    return
-            time.sleep(0.01)
-        self.fail(f"data: {data!r}; expected: {text!r}")
+            if data == text:
+                return
+            timeout = stop_at - time.monotonic()
+            if timeout <= 0 or not self.written.wait(timeout):
+                self.fail(f"data: {data!r}; expected: {text!r}")
 
     def test_on_disconnect(self):
         self.client.login(USER, PASSWD)
         self.client.close()
-        self.read_file(f"on_connect,on_login:{USER},on_disconnect,")
+        self.read_file(self._PREFIX + "on_disconnect,")
 
     def test_on_logout_quit(self):
         self.client.login(USER, PASSWD)
         self.client.sendcmd("quit")
-        self.read_file(
-            f"on_connect,on_login:{USER},on_logout:{USER},on_disconnect,"
-        )
+        self.read_file(self._PREFIX + f"on_logout:{USER},on_disconnect,")
 
     def test_on_logout_rein(self):
         self.client.login(USER, PASSWD)
         self.client.sendcmd("rein")
-        self.read_file(f"on_connect,on_login:{USER},on_logout:{USER},")
+        self.read_file(self._PREFIX + f"on_logout:{USER},")
 
     def test_on_logout_no_pass(self):
         # make sure on_logout() is not called if USER was provided
@@ -2015,9 +2067,7 @@ class TestCallbacks(PyftpdlibTestCase):
         # then quit and expect queue == ["user", "anonymous"]
         self.client.login(USER, PASSWD)
         self.client.login("anonymous")
-        self.read_file(
-            f"on_connect,on_login:{USER},on_logout:{USER},on_login:anonymous,"
-        )
+        self.read_file(self._PREFIX + f"on_logout:{USER},on_login:anonymous,")
 
     def test_on_login_failed(self):
         with pytest.raises(ftplib.error_perm):
@@ -2025,73 +2075,77 @@ class TestCallbacks(PyftpdlibTestCase):
         self.read_file("on_connect,on_login_failed:foo+bar?!?,")
 
     def test_on_file_received(self):
-        data = b"abcde12345" * 100000
-        dummyfile = io.BytesIO()
-        dummyfile.write(data)
-        dummyfile.seek(0)
+        data = get_payload(PAYLOAD_TIMES)
+        dummyfile = io.BytesIO(data)
         self.client.login(USER, PASSWD)
         self.client.storbinary("stor " + self.testfn2, dummyfile)
-        self.read_file(
-            f"on_connect,on_login:{USER},on_file_received:{self.testfn2},"
-        )
+        self.read_file(self._PREFIX + f"on_file_received:{self.testfn2},")
 
     def test_on_file_sent(self):
         self.client.login(USER, PASSWD)
-        data = b"abcde12345" * 100000
+        # The content is not checked: a sparse file of the same size
+        # as the payload is created without writing anything to disk.
         with open(self.testfn2, "wb") as f:
-            f.write(data)
-        self.client.retrbinary("retr " + self.testfn2, lambda x: x)
-        self.read_file(
-            f"on_connect,on_login:{USER},on_file_sent:{self.testfn2},"
-        )
+            f.truncate(len(get_payload(PAYLOAD_TIMES)))
+        # the data is thrown away: receive it into one reused buffer
+        self.client.voidcmd("TYPE I")
+        with contextlib.closing(
+            self.client.transfercmd("retr " + self.testfn2)
+        ) as conn:
+            buf = bytearray(BUFSIZE)
+            while conn.recv_into(buf):
+                pass
+        self.client.voidresp()
+        self.read_file(self._PREFIX + f"on_file_sent:{self.testfn2},")
 
     @retry_on_failure
     def test_on_incomplete_file_received(self):
         self.client.login(USER, PASSWD)
-        data = b"abcde12345" * 1000000
-        dummyfile = io.BytesIO()
-        dummyfile.write(data)
-        dummyfile.seek(0)
+        view = memoryview(get_payload(1000000))
         with contextlib.closing(
             self.client.transfercmd("stor " + self.testfn2)
         ) as conn:
             bytes_sent = 0
-            while True:
-                chunk = dummyfile.read(BUFSIZE)
+            while bytes_sent < INTERRUPTED_TRANSF_SIZE:
+                chunk = view[bytes_sent : bytes_sent + BUFSIZE]
                 conn.sendall(chunk)
                 bytes_sent += len(chunk)
-                # stop transfer while it isn't finished yet
-                if bytes_sent >= INTERRUPTED_TRANSF_SIZE or not chunk:
-                    self.client.putcmd("abor")
-                    break
-        # If a data transfer is in progress server is supposed to send
-        # a 426 reply followed by a 226 reply.
-        resp = self.client.getmultiline()
-        assert resp == "426 Transfer aborted via ABOR."
-        resp = self.client.getmultiline()
-        assert resp.startswith("226")
+            # By the time the server processes NOOP the data sent above
+            # is readable too, so the transfer is surely in progress
+            # when ABOR arrives.
+            self.client.sendcmd("noop")
+            # stop transfer while it isn't finished yet
+            self.client.putcmd("abor")
+            # If a data transfer is in progress server is supposed to
+            # send a 426 reply followed by a 226 reply. The data
+            # connection must stay open until then: on EOF the server
+            # would complete the upload instead.
+            resp = self.client.getmultiline()
+            assert resp == "426 Transfer aborted via ABOR."
+            resp = self.client.getmultiline()
+            assert resp.startswith("226")
         self.read_file(
-            f"on_connect,on_login:{USER},on_incomplete_file_received:{self.testfn2},"
+            self._PREFIX + f"on_incomplete_file_received:{self.testfn2},"
         )
 
     @retry_on_failure
     def test_on_incomplete_file_sent(self):
         self.client.login(USER, PASSWD)
-        data = b"abcde12345" * 1000000
-        with open(self.testfn2, "wb") as f:
-            f.write(data)
+        data = get_payload(1000000)
+        pathlib.Path(self.testfn2).write_bytes(data)
         bytes_recv = 0
         with contextlib.closing(
             self.client.transfercmd("retr " + self.testfn2, None)
         ) as conn:
+            buf = bytearray(BUFSIZE)
             while True:
-                chunk = conn.recv(BUFSIZE)
-                bytes_recv += len(chunk)
-                if bytes_recv >= INTERRUPTED_TRANSF_SIZE or not chunk:
+                n = conn.recv_into(buf)
+                bytes_recv += n
+                if bytes_recv >= INTERRUPTED_TRANSF_SIZE or n == 0:
                     break
         assert self.client.getline()[:3] == "426"
         self.read_file(
-            f"on_connect,on_login:{USER},on_incomplete_file_sent:{self.testfn2},"
+            self._PREFIX + f"on_incomplete_file_sent:{self.testfn2},"
         )
 
 
@@ -2167,7 +2221,7 @@ class _TestNetworkProtocols:
             assert "Network protocol not supported" in resp
 
         # test connection
-        with contextlib.closing(socket.socket(self.client.af)) as sock:
+        with socket.socket(self.client.af) as sock:
             sock.bind((self.client.sock.getsockname()[0], 0))
             sock.listen(5)
             sock.settimeout(GLOBAL_TIMEOUT)
@@ -2193,9 +2247,7 @@ class _TestNetworkProtocols:
             host, port = ftplib.parse229(
                 self.client.sendcmd(cmd), self.client.sock.getpeername()
             )
-            with contextlib.closing(
-                socket.socket(self.client.af, socket.SOCK_STREAM)
-            ) as s:
+            with socket.socket(self.client.af, socket.SOCK_STREAM) as s:
                 s.settimeout(GLOBAL_TIMEOUT)
                 s.connect((host, port))
                 self.client.sendcmd("abor")
@@ -2254,9 +2306,7 @@ class TestIPv4Environment(_TestNetworkProtocols, PyftpdlibTestCase):
 
     def test_pasv_v4(self):
         host, port = ftplib.parse227(self.client.sendcmd("pasv"))
-        with contextlib.closing(
-            socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        ) as s:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.settimeout(GLOBAL_TIMEOUT)
             s.connect((host, port))
 
@@ -2352,9 +2402,7 @@ class TestIPv6MixedEnvironment(PyftpdlibTestCase):
         self.client.connect("127.0.0.1", self.server.port)
         self.client.login(USER, PASSWD)
         # test connection
-        with contextlib.closing(
-            socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        ) as sock:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             sock.bind((self.client.sock.getsockname()[0], 0))
             sock.listen(5)
             sock.settimeout(2)
@@ -2377,9 +2425,7 @@ class TestIPv6MixedEnvironment(PyftpdlibTestCase):
             self.client.sendcmd("EPSV"), self.client.sock.getpeername()
         )
         assert host == "127.0.0.1"
-        with contextlib.closing(
-            socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        ) as s:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.settimeout(GLOBAL_TIMEOUT)
             s.connect((host, port))
             assert mlstline("mlst /").endswith("/")
@@ -2412,17 +2458,15 @@ class TestCornerCases(PyftpdlibTestCase):
         # The original server behavior was to reply with "200 Active
         # data connection established" *after* the client had already
         # disconnected the control connection.
-        with contextlib.closing(socket.socket(self.client.af)) as sock:
+        with socket.socket(self.client.af) as sock:
             sock.bind((self.client.sock.getsockname()[0], 0))
             sock.listen(5)
             sock.settimeout(GLOBAL_TIMEOUT)
             host, port = sock.getsockname()[:2]
 
-            hbytes = host.split(".")
-            pbytes = [repr(port // 256), repr(port % 256)]
-            data = hbytes + pbytes
-            cmd = "PORT " + ",".join(data) + "\r\n"
-            self.client.sock.sendall(bytes(cmd, "latin-1"))
+            ip = map(int, host.split("."))
+            cmd = b"PORT %d,%d,%d,%d,%d,%d\r\n" % (*ip, port >> 8, port & 0xFF)
+            self.client.sock.sendall(cmd)
             self.client.getresp()
             s, _ = sock.accept()
             s.close()
@@ -2435,14 +2479,9 @@ class TestCornerCases(PyftpdlibTestCase):
         # Tracked in issues #91, #104 and #105.
         # See also https://bugs.launchpad.net/zodb/+bug/135108
         def connect(addr):
-            with contextlib.closing(socket.socket()) as s:
-                # Set SO_LINGER to 1,0 causes a connection reset (RST) to
-                # be sent when close() is called, instead of the standard
-                # FIN shutdown sequence.
+            with socket.socket() as s:
                 s.setsockopt(
-                    socket.SOL_SOCKET,
-                    socket.SO_LINGER,
-                    struct.pack("ii", 1, 0),
+                    socket.SOL_SOCKET, socket.SO_LINGER, SO_LINGER_RST
                 )
                 s.settimeout(GLOBAL_TIMEOUT)
                 try:
@@ -2450,8 +2489,13 @@ class TestCornerCases(PyftpdlibTestCase):
                 except OSError:
                     pass
 
-        for _ in range(10):
-            connect((self.server.host, self.server.port))
+        # Fire the control connections all at once, so that the server
+        # also has to deal with them being reset concurrently.
+        addr = (self.server.host, self.server.port)
+        with concurrent.futures.ThreadPoolExecutor(10) as executor:
+            list(executor.map(connect, [addr] * 10))
+        # Each PASV closes the previous passive socket, so these have
+        # to be done one at a time.
         for _ in range(10):
             addr = self.client.makepasv()
             connect(addr)
@@ -2463,11 +2507,12 @@ class TestCornerCases(PyftpdlibTestCase):
         server = FTPServer((HOST, 0), FTPHandler)
         logger = logging.getLogger("pyftpdlib")
         logger.disabled = True
+        ioloop = server.ioloop
         try:
-            len1 = len(IOLoop.instance().socket_map)
-            IOLoop.instance().call_later(0, lambda: 1 // 0)
+            len1 = len(ioloop.socket_map)
+            ioloop.call_later(0, lambda: 1 // 0)
             server.serve_forever(timeout=0.001, blocking=False)
-            len2 = len(IOLoop.instance().socket_map)
+            len2 = len(ioloop.socket_map)
             assert len1 == len2
         finally:
             logger.disabled = False
@@ -2477,7 +2522,7 @@ class TestCornerCases(PyftpdlibTestCase):
         # we open a socket() but avoid to invoke accept() to
         # reproduce this error condition:
         # https://code.google.com/p/pyftpdlib/source/detail?r=905
-        with contextlib.closing(socket.socket()) as sock:
+        with socket.socket() as sock:
             sock.bind((HOST, 0))
             port = sock.getsockname()[1]
             self.client.sock.settimeout(0.1)
@@ -2492,8 +2537,10 @@ class TestCornerCases(PyftpdlibTestCase):
 
     def test_repr(self):
         # make sure the FTP/DTP handler classes have a sane repr()
+        socket_map = self.server.server.ioloop.socket_map
         with contextlib.closing(self.client.makeport()):
-            for inst in IOLoop.instance().socket_map.values():
+            # take a snapshot: the map is mutated by the server thread
+            for inst in list(socket_map.values()):
                 repr(inst)
                 str(inst)
 
@@ -2675,7 +2722,7 @@ class TestCornerCases(PyftpdlibTestCase):
 #                 )
 
 
-class ThreadedFTPTests(PyftpdlibTestCase):
+class ThreadedFTPTests(SharedServerTestCase):
 
     server_class = FtpdThreadWrapper
     client_class = ftplib.FTP
@@ -2683,23 +2730,12 @@ class ThreadedFTPTests(PyftpdlibTestCase):
     def setUp(self):
         super().setUp()
         self.client = None
-        self.server = None
-        self.tempfile = self.get_testfn()
-        self.tempdir = self.get_testfn()
-        touch(self.tempfile)
-        touch(self.tempdir)
-        self.dummy_recvfile = io.BytesIO()
-        self.dummy_sendfile = io.BytesIO()
 
     def tearDown(self):
         if self.client:
             close_client(self.client)
-        if self.server:
-            self.server.stop()
-            self.server.handler = FTPHandler
-            self.server.handler.abstracted_fs = AbstractedFS
-        self.dummy_recvfile.close()
-        self.dummy_sendfile.close()
+        # not reset by reset_server_opts()
+        self.server.handler.abstracted_fs = AbstractedFS
         super().tearDown()
 
     def connect_client(self):
@@ -2719,9 +2755,7 @@ class ThreadedFTPTests(PyftpdlibTestCase):
                     errno.EEXIST, "No usable temporary file name found"
                 )
 
-        self.server = self.server_class()
         self.server.handler.abstracted_fs = TestFS
-        self.server.start()
         self.connect_client()
         with pytest.raises(ftplib.error_temp, match="No usable unique file"):
             self.client.sendcmd("stou")
@@ -2731,17 +2765,14 @@ class ThreadedFTPTests(PyftpdlibTestCase):
         # Test control channel timeout.  The client which does not send
         # any command within the time specified in FTPHandler.timeout is
         # supposed to be kicked off.
-        self.server = self.server_class()
         self.server.handler.timeout = 0.1
-        self.server.start()
         self.connect_client()
 
         self.client.quit()
         self.client.connect()
         self.client.login(USER, PASSWD)
         # fail if no msg is received within 1 second
-        self.client.sock.settimeout(1)
-        data = self.client.sock.recv(BUFSIZE)
+        data = recv_line(self.client.sock)
         assert data == b"421 Control connection timed out.\r\n"
         # ensure client has been kicked off
         with pytest.raises((OSError, EOFError)):
@@ -2749,24 +2780,19 @@ class ThreadedFTPTests(PyftpdlibTestCase):
 
     @retry_on_failure
     def test_permit_foreign_address_false(self):
-        self.server = self.server_class()
         self.server.handler.permit_foreign_addresses = False
-        self.server.start()
         self.connect_client()
         handler = get_server_handler()
         handler.remote_ip = "9.9.9.9"
         # sync
         self.client.sendcmd("noop")
-        port = self.client.sock.getsockname()[1]
-        host = self.client.sock.getsockname()[0]
+        host, port = self.client.sock.getsockname()[:2]
         with pytest.raises(ftplib.error_perm, match="foreign address"):
             self.client.sendport(host, port)
 
     @retry_on_failure
     def test_permit_foreign_address_true(self):
-        self.server = self.server_class()
         self.server.handler.permit_foreign_addresses = True
-        self.server.start()
         self.connect_client()
         handler = get_server_handler()
         handler.remote_ip = "9.9.9.9"
@@ -2779,50 +2805,31 @@ class ThreadedFTPTests(PyftpdlibTestCase):
     def test_permit_privileged_ports(self):
         # Test FTPHandler.permit_privileged_ports_active attribute
 
-        # try to bind a socket on a privileged port
+        # try to bind a socket on a privileged port, which on POSIX
+        # requires root privileges
         sock = None
-        for port in reversed(range(1, 1024)):
-            try:
-                socket.getservbyport(port)
-            except OSError:
-                # not registered port; go on
+        if not hasattr(os, "geteuid") or os.geteuid() == 0:
+            for port in (1023, 1021, 1019):
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.addCleanup(sock.close)
-                    sock.settimeout(GLOBAL_TIMEOUT)
-                    sock.bind((HOST, port))
+                    s.bind((HOST, port))
+                except OSError:
+                    s.close()
+                else:
+                    self.addCleanup(s.close)
+                    sock = s
                     break
-                except OSError as err:
-                    if err.errno == errno.EACCES:
-                        # root privileges needed
-                        if sock is not None:
-                            sock.close()
-                        sock = None
-                        break
-                    sock.close()
-                    continue
-            else:
-                # registered port found; skip to the next one
-                continue
-        else:
-            # no usable privileged port was found
-            sock = None
 
         # permit_privileged_ports = False
-        self.server = self.server_class()
         self.server.handler.permit_privileged_ports = False
-        self.server.start()
         self.connect_client()
         with pytest.raises(ftplib.error_perm, match="privileged port"):
             self.client.sendport(HOST, 1023)
 
         # permit_privileged_ports = True
         if sock:
-            self.tearDown()
-
-            self.server = self.server_class()
+            close_client(self.client)
             self.server.handler.permit_privileged_ports = True
-            self.server.start()
             self.connect_client()
             port = sock.getsockname()[1]
             sock.listen(5)
@@ -2841,22 +2848,20 @@ class ThreadedFTPTests(PyftpdlibTestCase):
         # Makes sure that if sendfile() fails and no bytes were
         # transmitted yet the server falls back on using plain
         # send()
-        self.server = self.server_class()
-        self.server.start()
         self.connect_client()
-        data = b"abcde12345" * 100000
-        self.dummy_sendfile.write(data)
-        self.dummy_sendfile.seek(0)
-        self.client.storbinary("stor " + self.tempfile, self.dummy_sendfile)
+        testfn = self.get_testfn()
+        data = get_payload(PAYLOAD_TIMES)
+        # BytesIO shares the (cached) payload buffer instead of
+        # copying it
+        self.client.storbinary("stor " + testfn, io.BytesIO(data))
         with patch(
             "pyftpdlib.handlers.ftp.control.os.sendfile",
             side_effect=OSError(errno.EINVAL),
         ) as fun:
-            self.client.retrbinary(
-                "retr " + self.tempfile, self.dummy_recvfile.write
-            )
+            recvfile = io.BytesIO()
+            self.client.retrbinary("retr " + testfn, recvfile.write)
             assert fun.called
-            self.dummy_recvfile.seek(0)
-            datafile = self.dummy_recvfile.read()
-            assert len(data) == len(datafile)
-            assert hash(data) == hash(datafile)
+            # compare in place, without copying the received data out
+            with recvfile.getbuffer() as datafile:
+                assert len(data) == len(datafile)
+                assert datafile == data
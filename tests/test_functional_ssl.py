@@ -21,6 +21,7 @@ from . import WINDOWS
 from . import FtpdThreadWrapper
 from . import PyftpdlibTestCase
 from . import close_client
+from .test_functional import TestConfigurableHandlerOptions
 from .test_functional import TestConfigurableOptions
 from .test_functional import TestCornerCases
 from .test_functional import TestFtpAbort
@@ -68,6 +69,7 @@ class FTPSServer(FtpdThreadWrapper):
 class TLSTestMixin:
     server_class = FTPSServer
     client_class = FTPSClient
+    use_tls = True
 
 
 class TestFtpAuthenticationTLSMixin(TLSTestMixin, TestFtpAuthentication):
@@ -143,6 +145,12 @@ class TestConfigurableOptionsTLSMixin(TLSTestMixin, TestConfigurableOptions):
     pass
 
 
+class TestConfigurableHandlerOptionsTLSMixin(
+    TLSTestMixin, TestConfigurableHandlerOptions
+):
+    pass
+
+
 class TestIPv4EnvironmentTLSMixin(TLSTestMixin, TestIPv4Environment):
     pass
 
@@ -70,6 +70,14 @@ class TestFTPServer(PyftpdlibTestCase):
         with servers.FTPServer((HOST, 0), handlers.FTPHandler) as server:
             assert server is not None
 
+    def test_serve_forever_non_blocking(self):
+        # serve_forever(blocking=False) is supposed to return the
+        # timeout of the next scheduled call
+        with servers.FTPServer((HOST, 0), handlers.FTPHandler) as server:
+            server.ioloop.call_later(10, lambda: None)
+            soonest = server.serve_forever(timeout=0.001, blocking=False)
+            assert 0 < soonest <= 10
+
 
 # =====================================================================
 # --- threaded FTP server mixin tests